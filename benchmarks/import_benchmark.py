@@ -0,0 +1,67 @@
+"""pybis import time benchmark.
+
+Times fresh interpreters importing pybis the ways our short-lived jobs do, so a
+change that makes "import pybis" pull in GDAL, pymongo or sciencebasepy again
+shows up as a jump in the numbers.
+
+Example:
+
+    python benchmarks/import_benchmark.py --runs 20
+
+Each snippet is run --runs times in a new interpreter and the median and best
+wall clock times are printed in milliseconds.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+SNIPPETS = {
+    "python startup": "pass",
+    "import pybis": "import pybis",
+    "pybis.bis.Bis.clean_scientific_name": "import pybis; pybis.bis.Bis.clean_scientific_name",
+    "pybis.__version__": "import pybis; pybis.__version__",
+    "pybis.sfr.SfrPipeline": "import pybis; pybis.sfr.SfrPipeline"
+}
+
+
+def time_snippet(snippet, runs):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..") + os.pathsep + env.get("PYTHONPATH", "")
+
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, "-c", snippet], env=env, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE)
+        elapsed = time.perf_counter() - start
+        if completed.returncode != 0:
+            return {"error": completed.stderr.decode().strip().splitlines()[-1]}
+        timings.append(elapsed * 1000)
+
+    return {"median_ms": round(statistics.median(timings), 1), "best_ms": round(min(timings), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pybis import time")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--output", help="Append the results as a JSON line to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, snippet in SNIPPETS.items():
+        results[name] = time_snippet(snippet, args.runs)
+        print("%-40s %s" % (name, results[name]))
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(results) + "\n")
+
+
+if __name__ == "__main__":
+    main()
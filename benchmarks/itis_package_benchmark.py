@@ -0,0 +1,185 @@
+"""ITIS packaging benchmark.
+
+Times Itis.package_itis_json and Itis.package_itis_json_many against synthetic
+ITIS Solr docs shaped like the ones we repackage from the cache, alongside the
+previous packager (kept here as legacy_package_itis_json) so a regression in
+the hot loop shows up as the speedup shrinking.
+
+Example:
+
+    python benchmarks/itis_package_benchmark.py --docs 20000 --ranks 20 --vernaculars 4
+
+Each packager is run --runs times and the best docs/sec is printed. The
+packaged output is checked against the legacy packager before timing.
+
+On its own the script is informational. Pass --min-speedup to use it as a
+guard: it exits with status 1 when package_itis_json_many is slower than the
+legacy packager by more than that factor, e.g. --min-speedup 0.95 fails a
+change that makes packaging more than 5% slower than before.
+"""
+
+import argparse
+import copy
+import gc
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pybis.itis import Itis
+
+
+RANKS = ["Kingdom", "Subkingdom", "Infrakingdom", "Phylum", "Subphylum", "Infraphylum", "Superclass", "Class",
+         "Subclass", "Infraclass", "Superorder", "Order", "Suborder", "Infraorder", "Superfamily", "Family",
+         "Subfamily", "Tribe", "Subtribe", "Genus", "Subgenus", "Species", "Subspecies"]
+
+
+def legacy_package_itis_json(itisDoc):
+    itisData = {}
+    itisData["cacheDate"] = datetime.utcnow().isoformat()
+
+    if type(itisDoc) is not int:
+        primaryKeysToPop = ["_version_", "credibilityRating", "expert", "geographicDivision", "hierarchicalSort",
+                            "hierarchyTSN", "jurisdiction", "publication", "rankID", "otherSource", "taxonAuthor",
+                            "comment"]
+
+        for key in primaryKeysToPop:
+            itisDoc.pop(key, None)
+
+        itisDoc["taxonomy"] = []
+        for rank in itisDoc['hierarchySoFarWRanks'][0][itisDoc['hierarchySoFarWRanks'][0].find(':$') + 2:-1].split(
+                "$"):
+            thisRankName = {}
+            thisRankName["rank"] = rank.split(":")[0]
+            thisRankName["name"] = rank.split(":")[1]
+            itisDoc["taxonomy"].append(thisRankName)
+        itisDoc.pop("hierarchySoFarWRanks", None)
+
+        itisDoc["hierarchy"] = itisDoc["hierarchySoFar"][0].split(":")[1][1:-1].split("$")
+        itisDoc.pop("hierarchySoFar", None)
+
+        if "vernacular" in itisDoc:
+            itisDoc["commonnames"] = []
+            for commonName in itisDoc['vernacular']:
+                thisCommonName = {}
+                thisCommonName["name"] = commonName.split('$')[1]
+                thisCommonName["language"] = commonName.split('$')[2]
+                itisDoc["commonnames"].append(thisCommonName)
+            itisDoc.pop("vernacular", None)
+
+        itisData.update(itisDoc)
+
+    return itisData
+
+
+def build_itis_doc(tsn, ranks, vernaculars):
+    """
+    Build a synthetic ITIS Solr doc
+    :param tsn: TSN for the doc
+    :param ranks: Number of ranks in the hierarchy
+    :param vernaculars: Number of common names
+    :return: Dict shaped like an ITIS Solr doc
+    """
+    names = ["Taxon%d%s" % (tsn, rank.lower()) for rank in RANKS[:ranks]]
+    doc = {
+        "tsn": str(tsn),
+        "nameWInd": names[-1],
+        "nameWOInd": names[-1],
+        "usage": "valid",
+        "rank": RANKS[ranks - 1],
+        "parentTSN": str(tsn - 1),
+        "createDate": "2012-12-21 00:00:00",
+        "updateDate": "2014-01-01 00:00:00",
+        "_version_": random.randint(0, 2 ** 60),
+        "credibilityRating": "Verified - standards met",
+        "expert": ["$Expert$Reference$"],
+        "geographicDivision": ["North America"],
+        "hierarchicalSort": "0" * ranks,
+        "hierarchyTSN": ["$" + "$".join(str(tsn - i) for i in range(ranks)) + "$"],
+        "jurisdiction": ["Continental US$Native"],
+        "publication": ["$Publication$1999$"],
+        "rankID": 220,
+        "otherSource": ["$Source$1$"],
+        "taxonAuthor": "Author, 1758",
+        "comment": ["Comment"],
+        "hierarchySoFarWRanks": ["%d:$%s$" % (tsn, "$".join("%s:%s" % (r, n) for r, n in zip(RANKS, names)))],
+        "hierarchySoFar": ["%d:$%s$" % (tsn, "$".join(names))],
+        "vernacular": ["$common name %d$English$N$%d$2012-12-21 00:00:00$" % (i, tsn) for i in range(vernaculars)]
+    }
+    return doc
+
+
+def time_packager(packager, docs):
+    run_docs = copy.deepcopy(docs)
+    # Collector passes over the copied docs would swamp the packaging time, so keep it off like timeit does
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        packager(run_docs)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark packaging of ITIS docs")
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--ranks", type=int, default=20)
+    parser.add_argument("--vernaculars", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Append the results as a JSON line to this file")
+    parser.add_argument("--min-speedup", type=float,
+                        help="Exit with status 1 if package_itis_json_many over the legacy packager is below this")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    ranks = max(1, min(args.ranks, len(RANKS)))
+    docs = [build_itis_doc(180000 + i, ranks, args.vernaculars) for i in range(args.docs)]
+
+    # The packagers must agree on everything but the cache timestamp
+    expected = legacy_package_itis_json(copy.deepcopy(docs[0]))
+    actual = Itis.package_itis_json(copy.deepcopy(docs[0]))
+    expected.pop("cacheDate")
+    actual.pop("cacheDate")
+    if expected != actual:
+        raise Exception("package_itis_json output differs from the legacy packager")
+
+    packagers = {
+        "legacy_package_itis_json": lambda d: [legacy_package_itis_json(doc) for doc in d],
+        "package_itis_json": lambda d: [Itis.package_itis_json(doc) for doc in d],
+        "package_itis_json_many": Itis.package_itis_json_many
+    }
+
+    # Runs are interleaved so drift in machine load hits every packager alike
+    best = dict((name, None) for name in packagers)
+    for i in range(args.runs):
+        for name, packager in packagers.items():
+            elapsed = time_packager(packager, docs)
+            best[name] = elapsed if best[name] is None else min(best[name], elapsed)
+
+    results = {"docs": args.docs, "ranks": ranks, "vernaculars": args.vernaculars}
+    for name in packagers:
+        results[name] = {"docs_per_second": round(args.docs / best[name]), "best_seconds": round(best[name], 4)}
+        print("%-30s %s" % (name, results[name]))
+
+    legacy = results["legacy_package_itis_json"]["docs_per_second"]
+    results["speedup"] = round(results["package_itis_json_many"]["docs_per_second"] / legacy, 2)
+    print("%-30s %sx" % ("speedup", results["speedup"]))
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(results) + "\n")
+
+    if args.min_speedup is not None and results["speedup"] < args.min_speedup:
+        print("Speedup %sx is below the required %sx" % (results["speedup"], args.min_speedup))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
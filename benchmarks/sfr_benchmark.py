@@ -0,0 +1,245 @@
+"""SFR pipeline benchmark.
+
+Runs SfrPipeline against synthetic point, line and multipolygon data without
+ScienceBase, Postgis or pg2elastic. The zip file is built locally, features are
+written to a GeoPackage standing in for Postgis, and a stub HTTP server answers
+the pg2elastic reindex request.
+
+Example:
+
+    python benchmarks/sfr_benchmark.py --features 50000 --vertices 200 --clean-up-geom --output results.jsonl
+    python benchmarks/sfr_benchmark.py --geometry multipolygon --reproject
+
+Each run prints (and optionally appends to --output) features/sec, RSS and the
+per-stage timings for copy_features, fix_geometry, spatial_file_to_postgis (the
+load on its own) and index_queue.
+
+Every geometry type runs in its own spawned process, so peak_rss_kb is the peak
+for that case alone. rss_increase_kb is how far the peak rose while the pipeline
+ran, above what building the synthetic data had already reached.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from osgeo import ogr, osr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pybis.sfr import SfrPipeline
+
+
+GEOMETRY_TYPES = {
+    "point": ogr.wkbPoint,
+    "line": ogr.wkbLineString,
+    "multipolygon": ogr.wkbMultiPolygon
+}
+
+DRIVERS = {
+    ".shp": "ESRI Shapefile",
+    ".geojson": "GeoJSON"
+}
+
+
+class StubPg2ElasticHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = json.dumps({"status": "queued", "request": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalSfrPipeline(SfrPipeline):
+    """SfrPipeline that reads a local zip file instead of downloading one from ScienceBase"""
+
+    def get_zip_file_and_extract(self):
+        self.zip_name = os.path.basename(self.zip_file)
+        self.zip_cached = True
+        if self.read_from_zip:
+            self.directory = "/vsizip/" + self.zip_file
+        else:
+            with self.time_stage("extract", zip_file=self.zip_file):
+                self.extract_zip_file()
+
+
+def build_geometry(geometry_type, vertices):
+    """
+    Build a random geometry of the given type centered somewhere in the lower 48
+    :param geometry_type: "point", "line" or "multipolygon"
+    :param vertices: Number of vertices per line or polygon ring
+    :return: OGR geometry
+    """
+    x = random.uniform(-124.0, -67.0)
+    y = random.uniform(25.0, 49.0)
+
+    if geometry_type == "point":
+        geom = ogr.Geometry(ogr.wkbPoint)
+        geom.AddPoint_2D(x, y)
+        return geom
+
+    if geometry_type == "line":
+        geom = ogr.Geometry(ogr.wkbLineString)
+        for i in range(vertices):
+            geom.AddPoint_2D(x + i * 0.001, y + random.uniform(-0.001, 0.001))
+        return geom
+
+    geom = ogr.Geometry(ogr.wkbMultiPolygon)
+    for part in range(2):
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        radius = random.uniform(0.05, 0.2)
+        for i in range(vertices):
+            angle = 2 * math.pi * i / vertices
+            ring.AddPoint_2D(x + part * 0.5 + radius * math.cos(angle), y + radius * math.sin(angle))
+        ring.CloseRings()
+        poly = ogr.Geometry(ogr.wkbPolygon)
+        poly.AddGeometry(ring)
+        geom.AddGeometry(poly)
+    return geom
+
+
+def build_synthetic_zip(work_dir, geometry_type, features, vertices, spatial_file_type):
+    """
+    Write a synthetic spatial file and zip it up the way SFR items are packaged in ScienceBase
+    :return: Path to the zip file
+    """
+    name = "synthetic_%s" % geometry_type
+    spatial_file = os.path.join(work_dir, name + spatial_file_type)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    data_source = ogr.GetDriverByName(DRIVERS[spatial_file_type]).CreateDataSource(spatial_file)
+    layer = data_source.CreateLayer(name, srs, GEOMETRY_TYPES[geometry_type])
+    layer.CreateField(ogr.FieldDefn("name", ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn("value", ogr.OFTReal))
+
+    layer_definition = layer.GetLayerDefn()
+    for i in range(features):
+        feature = ogr.Feature(layer_definition)
+        feature.SetField("name", "feature %d" % i)
+        feature.SetField("value", random.random() * 1000)
+        feature.SetGeometryDirectly(build_geometry(geometry_type, vertices))
+        layer.CreateFeature(feature)
+    data_source = None
+
+    zip_path = os.path.join(work_dir, name + ".zip")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for file in os.listdir(work_dir):
+            if file.startswith(name + ".") and not file.endswith(".zip"):
+                zf.write(os.path.join(work_dir, file), file)
+                os.remove(os.path.join(work_dir, file))
+    return zip_path
+
+
+def run_benchmark(args, geometry_type, pg2elastic_url):
+    random.seed(args.seed)
+    work_dir = tempfile.mkdtemp(prefix="sfr_benchmark_")
+    cwd = os.getcwd()
+    try:
+        zip_path = build_synthetic_zip(work_dir, geometry_type, args.features, args.vertices, args.spatial_file_type)
+        destination = os.path.join(work_dir, "sfr.gpkg")
+        ogr.GetDriverByName("GPKG").CreateDataSource(destination).Destroy()
+
+        os.environ["PG_TO_ELASTIC"] = pg2elastic_url
+        os.chdir(work_dir)
+        pipeline = LocalSfrPipeline(
+            item_id="benchmark",
+            table="synthetic_" + geometry_type,
+            srid=args.reproject_srid if args.reproject else 4326,
+            zipfile_title="benchmark",
+            spatial_file_list=[],
+            overwrite_existing_table="Yes",
+            spatial_file_type=args.spatial_file_type,
+            clean_up_geom=args.clean_up_geom and geometry_type == "multipolygon",
+            read_from_zip=args.read_from_zip,
+            reproject=args.reproject,
+            profile_copy_features=args.profile,
+            ogr_destination=destination
+        )
+        pipeline.zip_file = zip_path
+
+        rss_before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        pipeline.spatial_file_to_postgis()
+        load_seconds = time.perf_counter() - start
+        summary = pipeline.index_table()
+        summary["stages"]["spatial_file_to_postgis"] = {"calls": 1, "seconds": load_seconds}
+        peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "geometry_type": geometry_type,
+        "spatial_file_type": args.spatial_file_type,
+        "features": args.features,
+        "vertices": args.vertices,
+        "clean_up_geom": args.clean_up_geom,
+        "read_from_zip": args.read_from_zip,
+        "reproject_srid": args.reproject_srid if args.reproject else None,
+        "features_per_second": summary.get("features_per_second"),
+        "peak_rss_kb": peak_rss_kb,
+        "rss_increase_kb": peak_rss_kb - rss_before_kb,
+        "index_batch_size": summary["index_batch_size"],
+        "stages": summary["stages"],
+        "profile": summary.get("profile")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SFR pipeline against synthetic data")
+    parser.add_argument("--geometry", choices=sorted(GEOMETRY_TYPES) + ["all"], default="all")
+    parser.add_argument("--features", type=int, default=10000)
+    parser.add_argument("--vertices", type=int, default=100)
+    parser.add_argument("--spatial-file-type", choices=sorted(DRIVERS), default=".shp")
+    parser.add_argument("--clean-up-geom", action="store_true")
+    parser.add_argument("--read-from-zip", action="store_true")
+    parser.add_argument("--reproject", action="store_true",
+                        help="Load into --reproject-srid so every feature is transformed from EPSG:4326 while copying")
+    parser.add_argument("--reproject-srid", type=int, default=3857)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Append one JSON line per run to this file")
+    args = parser.parse_args()
+
+    server = HTTPServer(("127.0.0.1", 0), StubPg2ElasticHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pg2elastic_url = "http://127.0.0.1:%d" % server.server_port
+
+    geometry_types = sorted(GEOMETRY_TYPES) if args.geometry == "all" else [args.geometry]
+    # ru_maxrss only ever grows within a process, and a forked child inherits the parent's, so spawn one per case
+    context = multiprocessing.get_context("spawn")
+    try:
+        for geometry_type in geometry_types:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_benchmark, (args, geometry_type, pg2elastic_url))
+            profile = result.pop("profile")
+            print(json.dumps(result, indent=2))
+            if profile:
+                print(profile)
+            if args.output:
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
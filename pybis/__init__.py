@@ -18,29 +18,55 @@ Software metadata: retrieve using "bis.get_package_metadata()"
 
 """
 
-import pkg_resources  # part of setuptools
-
-
-# Import bis objects
-from . import bis
-from . import bison
-from . import db
-from . import gap
-from . import itis
-from . import iucn
-from . import natureserve
-from . import nhd
-from . import rrl
-from . import sfr
-from . import sgcn
-from . import tess
-from . import worms
-
-# provide version, PEP - three components ("major.minor.micro")
-__version__ = pkg_resources.require("pybis")[0].version
+import importlib
+
+
+# bis objects are imported on first access (PEP 562) so that a caller who only needs one module
+# doesn't pay for GDAL, pymongo, sciencebasepy, etc.
+_submodules = [
+    "bis",
+    "bison",
+    "db",
+    "gap",
+    "itis",
+    "iucn",
+    "natureserve",
+    "nhd",
+    "rrl",
+    "sfr",
+    "sgcn",
+    "tess",
+    "tir",
+    "worms"
+]
+
+
+def _distribution_metadata():
+    try:
+        from importlib import metadata
+    except ImportError:
+        import importlib_metadata as metadata
+    return metadata.metadata("pybis")
+
+
+def __getattr__(name):
+    if name in _submodules:
+        module = importlib.import_module("." + name, __name__)
+        globals()[name] = module
+        return module
+    if name == "__version__":
+        # provide version, PEP - three components ("major.minor.micro")
+        version = _distribution_metadata()["Version"]
+        globals()["__version__"] = version
+        return version
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + _submodules + ["__version__"])
+
 
 # metadata retrieval
 def get_package_metadata():
-    d = pkg_resources.get_distribution('pybis')
-    for i in d._get_metadata(d.PKG_INFO):
-        print(i)
+    for key, value in _distribution_metadata().items():
+        print("%s: %s" % (key, value))
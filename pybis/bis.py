@@ -1,7 +1,58 @@
 import requests
 import re
+import threading
+import time
 from ftfy import fix_text
 
+
+class RateLimiter:
+    def __init__(self, requestsPerSecond):
+        self.description = "Spaces out requests shared across threads so an API's rate limit is respected"
+        self.interval = 1.0 / requestsPerSecond
+        self.lock = threading.Lock()
+        self.nextRequest = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            waitTime = self.nextRequest - now
+            self.nextRequest = max(now, self.nextRequest) + self.interval
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+    def backoff(self, seconds):
+        # Push every thread's next request back, e.g. after a 429 with Retry-After
+        with self.lock:
+            self.nextRequest = max(self.nextRequest, time.monotonic() + seconds)
+
+
+class LRUCache:
+    def __init__(self, maxSize=10000):
+        from collections import OrderedDict
+        self.description = "Thread safe, size bounded cache that evicts the least recently used entries"
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
 class Bis:
     def __init__(self):
         self.description = "Set of functions for general use across the Biogeographic Information System"
@@ -11,3 +11,46 @@ class Bison:
             return bisonBaseSearchURL_json+"type=scientific_name&species="+bis.string_cleaning(criteria)
         else:
             return bisonBaseSearchURL_json+"tsn="+str(criteria)
+
+
+    def iter_bison_counts(queryType,criteriaList,maxWorkers=8):
+        import requests
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from datetime import datetime
+        from pybis.bison import Bison as bison
+
+        session = requests.Session()
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=maxWorkers))
+
+        def get_count(criteria):
+            bisonSummary = {"Query URL":bison.get_bison_search_url(queryType,criteria),"Date Checked":datetime.utcnow().isoformat(),"Success":False}
+            try:
+                bisonResponse = session.get(bisonSummary["Query URL"], timeout=(10, 60)).json()
+            except Exception as e:
+                bisonSummary["Error"] = str(e)
+                return bisonSummary
+
+            # Only keep the summary parts of the response, not the sample occurrence record
+            bisonSummary["Success"] = True
+            bisonSummary["Total"] = bisonResponse.get("total")
+            if "occurrences" in bisonResponse and "legend" in bisonResponse["occurrences"]:
+                bisonSummary["Occurrence Types"] = bisonResponse["occurrences"]["legend"]
+            return bisonSummary
+
+        # Results are yielded as they finish so callers can stream them somewhere instead of waiting on the whole set
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            futures = dict((executor.submit(get_count, criteria), criteria) for criteria in dict.fromkeys(criteriaList))
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+    def bison_counts(queryType,criteriaList,maxWorkers=8,asDataFrame=False):
+        from pybis.bison import Bison as bison
+
+        bisonCounts = dict(bison.iter_bison_counts(queryType,criteriaList,maxWorkers))
+
+        if asDataFrame:
+            import pandas as pd
+            return pd.DataFrame.from_dict(bisonCounts, orient="index")
+
+        return bisonCounts
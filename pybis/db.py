@@ -1,4 +1,5 @@
 import os
+import threading
 from pymongo import MongoClient
 
 """
@@ -13,8 +14,19 @@ MONGODB_DATABASE
 MONGODB_USERNAME
 MONGODB_SERVER
 MONGODB_PASSWORD
+
+These optional OS environment variables tune the shared MongoDB client:
+
+MONGODB_MAX_POOL_SIZE
+MONGODB_WRITE_CONCERN
+MONGODB_READ_PREFERENCE
 """
 
+# One MongoClient per URI and options, shared by every connect_mongodb call in this process
+_mongo_clients = {}
+_mongo_clients_lock = threading.Lock()
+_mongo_clients_pid = os.getpid()
+
 class Db:
 
     def __init__(self):
@@ -37,7 +49,37 @@ class Db:
         except Exception as e:
             return e
 
-    def connect_mongodb(db_name):
+    def get_mongo_client(mongo_uri, **client_options):
+        global _mongo_clients_pid
+
+        for env_var, option, cast in [("MONGODB_MAX_POOL_SIZE", "maxPoolSize", int),
+                                      ("MONGODB_WRITE_CONCERN", "w", lambda w: int(w) if w.isdigit() else w),
+                                      ("MONGODB_READ_PREFERENCE", "readPreference", str)]:
+            if option not in client_options and os.getenv(env_var):
+                client_options[option] = cast(os.environ[env_var])
+
+        client_key = (mongo_uri, tuple(sorted(client_options.items())))
+
+        with _mongo_clients_lock:
+            # MongoClient is not fork safe, so a forked worker builds its own clients instead of reusing the parent's
+            if _mongo_clients_pid != os.getpid():
+                _mongo_clients.clear()
+                _mongo_clients_pid = os.getpid()
+
+            client = _mongo_clients.get(client_key)
+            if client is None:
+                client = MongoClient(mongo_uri, connect=False, **client_options)
+                _mongo_clients[client_key] = client
+
+        return client
+
+    def close_mongo_clients():
+        with _mongo_clients_lock:
+            for client in _mongo_clients.values():
+                client.close()
+            _mongo_clients.clear()
+
+    def connect_mongodb(db_name, **client_options):
         mongo_uri = "mongodb://" + os.environ["MONGODB_USERNAME"] + ":" + os.environ["MONGODB_PASSWORD"] + "@" + os.environ["MONGODB_SERVER"] + "/" + os.environ["MONGODB_DATABASE"]
-        client = MongoClient(mongo_uri)
+        client = Db.get_mongo_client(mongo_uri, **client_options)
         return client.get_database(os.environ["MONGODB_DATABASE"])
@@ -1,50 +1,59 @@
+from datetime import datetime
+
+# Parts of the ITIS doc that we don't want/need to cache
+itisKeysToPop = ("_version_", "credibilityRating", "expert", "geographicDivision", "hierarchicalSort", "hierarchyTSN",
+                 "jurisdiction", "publication", "rankID", "otherSource", "taxonAuthor", "comment")
+
+
 class Itis:
     def __init__(self):
         self.description = "Set of functions for interacting with ITIS"
 
-    def package_itis_json(itisDoc):
-        from datetime import datetime
+    def package_itis_json(itisDoc, cacheDate=None):
         itisData = {}
-        itisData["cacheDate"] = datetime.utcnow().isoformat()
+        itisData["cacheDate"] = cacheDate or datetime.utcnow().isoformat()
 
         if type(itisDoc) is not int:
             # Get rid of parts of the ITIS doc that we don't want/need to cache
-            primaryKeysToPop = ["_version_", "credibilityRating", "expert", "geographicDivision", "hierarchicalSort",
-                                "hierarchyTSN", "jurisdiction", "publication", "rankID", "otherSource", "taxonAuthor",
-                                "comment"]
-
-            for key in primaryKeysToPop:
-                itisDoc.pop(key, None)
+            popKey = itisDoc.pop
+            for key in itisKeysToPop:
+                popKey(key, None)
 
             # Make a clean structure of the taconomic hierarchy
-            itisDoc["taxonomy"] = []
-            for rank in itisDoc['hierarchySoFarWRanks'][0][itisDoc['hierarchySoFarWRanks'][0].find(':$') + 2:-1].split(
-                    "$"):
-                thisRankName = {}
-                thisRankName["rank"] = rank.split(":")[0]
-                thisRankName["name"] = rank.split(":")[1]
-                itisDoc["taxonomy"].append(thisRankName)
-            itisDoc.pop("hierarchySoFarWRanks", None)
+            hierarchySoFarWRanks = popKey("hierarchySoFarWRanks")[0]
+            taxonomy = []
+            for rank in hierarchySoFarWRanks[hierarchySoFarWRanks.find(':$') + 2:-1].split("$"):
+                rankNameParts = rank.split(":")
+                taxonomy.append({"rank": rankNameParts[0], "name": rankNameParts[1]})
 
             # Make a clean, usable list of the hierarchy so far for display or listing
-            itisDoc["hierarchy"] = itisDoc["hierarchySoFar"][0].split(":")[1][1:-1].split("$")
-            itisDoc.pop("hierarchySoFar", None)
+            hierarchy = popKey("hierarchySoFar")[0].split(":")[1][1:-1].split("$")
+            vernacular = popKey("vernacular", None)
 
-            # Make a clean structure of common names
-            if "vernacular" in itisDoc:
-                itisDoc["commonnames"] = []
-                for commonName in itisDoc['vernacular']:
-                    thisCommonName = {}
-                    thisCommonName["name"] = commonName.split('$')[1]
-                    thisCommonName["language"] = commonName.split('$')[2]
-                    itisDoc["commonnames"].append(thisCommonName)
-                itisDoc.pop("vernacular", None)
-
-            # Add the new ITIS doc to the ITIS data structure and return
+            # Add the new ITIS doc to the ITIS data structure
             itisData.update(itisDoc)
+            itisData["taxonomy"] = taxonomy
+            itisData["hierarchy"] = hierarchy
+
+            # Make a clean structure of common names
+            if vernacular is not None:
+                commonNames = []
+                for commonName in vernacular:
+                    commonNameParts = commonName.split('$')
+                    commonNames.append({"name": commonNameParts[1], "language": commonNameParts[2]})
+                itisData["commonnames"] = commonNames
 
         return itisData
 
+    def package_itis_json_many(itisDocs):
+        """
+        Package a batch of ITIS docs with one shared cache timestamp
+        :param itisDocs: Iterable of ITIS Solr docs (or ints, as accepted by package_itis_json)
+        :return: List of packaged ITIS data in the same order
+        """
+        cacheDate = datetime.utcnow().isoformat()
+        return [Itis.package_itis_json(itisDoc, cacheDate) for itisDoc in itisDocs]
+
 
     def get_itis_search_url(searchstr, fuzzy=False, validAccepted=True):
         fuzzyLevel = "~0.8"
@@ -78,7 +87,6 @@ class Itis:
 
     def check_itis_solr(scientificname):
         import requests
-        from datetime import datetime
 
         # Set up itisResult structure to return and prep the processingMetadata, set a default for Summary Result to Not Matched
         itisResult = {}
@@ -88,7 +96,7 @@ class Itis:
         itisResult["processingMetadata"]["Detailed Results"] = []
 
         # Set up the primary search method for an exact match on scientific name
-        url_exactMatch = getITISSearchURL(scientificname, False, False)
+        url_exactMatch = Itis.get_itis_search_url(scientificname, False, False)
 
         # We have to try the main search queries because the ITIS service does not return an elegant error
         try:
@@ -103,7 +111,7 @@ class Itis:
             itisResult["processingMetadata"]["Detailed Results"].append({"Exact Match Fail": url_exactMatch})
 
             # if we didn't get anything with an exact name match, run the sequence using fuzziness level
-            url_fuzzyMatch = getITISSearchURL(scientificname, True, False)
+            url_fuzzyMatch = Itis.get_itis_search_url(scientificname, True, False)
 
             try:
                 r_fuzzyMatch = requests.get(url_fuzzyMatch).json()
@@ -123,10 +131,10 @@ class Itis:
 
                 # We need to check to see if the discovered ITIS record is accepted for use. If not, we need to follow the accepted TSN in that document
                 if r_fuzzyMatch["response"]["docs"][0]["usage"] in ["invalid", "not accepted"]:
-                    url_tsnSearch = getITISSearchURL(r_fuzzyMatch["response"]["docs"][0]["acceptedTSN"][0], False,
+                    url_tsnSearch = Itis.get_itis_search_url(r_fuzzyMatch["response"]["docs"][0]["acceptedTSN"][0], False,
                                                      False)
                     r_tsnSearch = requests.get(url_tsnSearch).json()
-                    itisResult["itisData"].append(packageITISJSON(r_tsnSearch["response"]["docs"][0]))
+                    itisResult["itisData"].append(Itis.package_itis_json(r_tsnSearch["response"]["docs"][0]))
                     itisResult["processingMetadata"]["Summary Result"] = "Followed Accepted TSN"
                     itisResult["processingMetadata"]["Detailed Results"].append({"TSN Search": url_tsnSearch})
                 else:
@@ -134,7 +142,7 @@ class Itis:
 
                 # Whether or not we needed to follow an accepted TSN, we will also include the ITIS record that was the point of discovery
                 itisResult["processingMetadata"]["Detailed Results"].append({"Fuzzy Match": url_fuzzyMatch})
-                itisResult["itisData"].append(packageITISJSON(r_fuzzyMatch["response"]["docs"][0]))
+                itisResult["itisData"].append(Itis.package_itis_json(r_fuzzyMatch["response"]["docs"][0]))
 
         elif r_exactMatch["response"]["numFound"] == 1:
             # If we found only one record with the exact match query, we treat that as a useful point of discovery
@@ -143,9 +151,9 @@ class Itis:
 
             # We need to check to see if the discovered ITIS record is accepted for use. If not, we need to follow the accepted TSN in that document
             if r_exactMatch["response"]["docs"][0]["usage"] in ["invalid", "not accepted"]:
-                url_tsnSearch = getITISSearchURL(r_exactMatch["response"]["docs"][0]["acceptedTSN"][0], False, False)
+                url_tsnSearch = Itis.get_itis_search_url(r_exactMatch["response"]["docs"][0]["acceptedTSN"][0], False, False)
                 r_tsnSearch = requests.get(url_tsnSearch).json()
-                itisResult["itisData"].append(packageITISJSON(r_tsnSearch["response"]["docs"][0]))
+                itisResult["itisData"].append(Itis.package_itis_json(r_tsnSearch["response"]["docs"][0]))
                 itisResult["processingMetadata"]["Summary Result"] = "Followed Accepted TSN"
                 itisResult["processingMetadata"]["Detailed Results"].append({"TSN Search": url_tsnSearch})
             else:
@@ -153,7 +161,7 @@ class Itis:
 
             # Whether or not we needed to follow an accepted TSN, we will also include the ITIS record that was the point of discovery
             itisResult["processingMetadata"]["Detailed Results"].append({"Exact Match": url_exactMatch})
-            itisResult["itisData"].append(packageITISJSON(r_exactMatch["response"]["docs"][0]))
+            itisResult["itisData"].append(Itis.package_itis_json(r_exactMatch["response"]["docs"][0]))
 
         elif r_exactMatch["response"]["numFound"] > 1:
             # If we find more than one document with an exact match search, we can make a few more decisions based on what's in the data before we need to punt the rest to human supervision
@@ -170,9 +178,9 @@ class Itis:
             if len(acceptedTSNs) == 1:
                 # Multiple exact matches were returned, but only one of them has an accepted TSN to follow
                 itisResult["itisData"] = []
-                url_tsnSearch = getITISSearchURL(acceptedTSNs[0], False, True)
+                url_tsnSearch = Itis.get_itis_search_url(acceptedTSNs[0], False, True)
                 r_tsnSearch = requests.get(url_tsnSearch).json()
-                itisResult["itisData"].append(packageITISJSON(r_tsnSearch["response"]["docs"][0]))
+                itisResult["itisData"].append(Itis.package_itis_json(r_tsnSearch["response"]["docs"][0]))
                 itisResult["processingMetadata"]["Summary Result"] = "Followed Accepted TSN"
                 itisResult["processingMetadata"]["Detailed Results"].append({"TSN Search": url_tsnSearch})
 
@@ -1,7 +1,136 @@
+import os
+
+"""
+Tools for working with the IUCN Red List API (v3).
+
+These OS environment variables must be set:
+
+IUCN_TOKEN
+
+IUCN_CACHE_DIRECTORY can be set to keep API responses and the species list on disk between runs.
+"""
+
+iucnBaseURL = "http://apiv3.iucnredlist.org/api/v3/"
+
+
 class Iucn:
     def __init__(self):
         self.description = 'Set of functions for working with the IUCN API'
 
 
     def get_species_search_url(scientificname):
-        return "http://apiv3.iucnredlist.org/api/v3/species/"+scientificname
\ No newline at end of file
+        return "http://apiv3.iucnredlist.org/api/v3/species/"+scientificname
+
+
+    def get_cache_file(scientificname, cacheDirectory):
+        import hashlib
+        return os.path.join(cacheDirectory, "species", hashlib.sha1(scientificname.lower().encode()).hexdigest() + ".json")
+
+
+    def lookup_iucn_species(scientificname, session=None, limiter=None, cacheDirectory=None):
+        import json
+        import requests
+        from pybis.iucn import Iucn as iucn
+
+        cacheDirectory = cacheDirectory or os.getenv("IUCN_CACHE_DIRECTORY")
+        if cacheDirectory is not None:
+            cacheFile = iucn.get_cache_file(scientificname, cacheDirectory)
+            if os.path.exists(cacheFile):
+                with open(cacheFile) as f:
+                    return json.load(f)
+
+        if limiter is not None:
+            limiter.wait()
+        response = (session or requests).get(iucn.get_species_search_url(scientificname),
+                                             params={"token":os.environ["IUCN_TOKEN"]}, timeout=(10, 60))
+        response.raise_for_status()
+        iucnResult = response.json()
+
+        # Error bodies ({"message": ...}) come back with a 200 too; only real answers are cached
+        if cacheDirectory is not None and "result" in iucnResult:
+            os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+            with open(cacheFile + ".part", "w") as f:
+                json.dump(iucnResult, f)
+            os.replace(cacheFile + ".part", cacheFile)
+
+        return iucnResult
+
+
+    def lookup_iucn_species_many(scientificnames, maxWorkers=4, requestsPerSecond=2, cacheDirectory=None, speciesIndex=None):
+        import requests
+        from concurrent.futures import ThreadPoolExecutor
+        from pybis.bis import RateLimiter
+        from pybis.iucn import Iucn as iucn
+
+        names = list(dict.fromkeys(scientificnames))
+        results = {}
+
+        # Names found in the downloaded species list are answered locally without touching the API. Every result
+        # says where it came from: "API" results are /species/{name} responses, while "Species List" results hold
+        # the shorter /species/page record (taxonid, scientific_name, the taxonomy, category and so on, but no
+        # authority, criteria, population_trend or assessment_date). Leave out speciesIndex when the full record
+        # is needed for every name.
+        if speciesIndex is not None:
+            for name in names:
+                if name.lower() in speciesIndex:
+                    results[name] = {"name":name,"result":[speciesIndex[name.lower()]],"Source":"Species List"}
+
+        limiter = RateLimiter(requestsPerSecond)
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=maxWorkers))
+
+        def lookup(name):
+            try:
+                iucnResult = iucn.lookup_iucn_species(name, session, limiter, cacheDirectory)
+            except Exception as e:
+                iucnResult = {"name":name,"error":str(e)}
+            iucnResult["Source"] = "API"
+            return iucnResult
+
+        toQuery = [name for name in names if name not in results]
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            results.update(zip(toQuery, executor.map(lookup, toQuery)))
+
+        return results
+
+
+    def build_species_index(cacheDirectory=None, refresh=False):
+        import json
+        import requests
+
+        # The full species list comes in pages of up to 10,000 records; it is downloaded once and kept on disk
+        cacheDirectory = cacheDirectory or os.getenv("IUCN_CACHE_DIRECTORY")
+        speciesListFile = os.path.join(cacheDirectory, "species_list.json") if cacheDirectory is not None else None
+
+        if speciesListFile is not None and os.path.exists(speciesListFile) and not refresh:
+            with open(speciesListFile) as f:
+                speciesList = json.load(f)
+        else:
+            speciesList = []
+            session = requests.Session()
+            page = 0
+            while True:
+                response = session.get(iucnBaseURL + "species/page/" + str(page), params={"token":os.environ["IUCN_TOKEN"]}, timeout=(10, 300))
+                response.raise_for_status()
+                pageBody = response.json()
+                # Errors such as an invalid token come back as a 200 with {"message": ...} and no result
+                if "result" not in pageBody:
+                    raise Exception("IUCN species list page %d failed: %s" % (page, pageBody.get("message", pageBody)))
+                if len(pageBody["result"]) == 0:
+                    break
+                speciesList.extend(pageBody["result"])
+                page = page + 1
+
+            if len(speciesList) == 0:
+                raise Exception("IUCN species list came back empty")
+
+            if speciesListFile is not None:
+                os.makedirs(cacheDirectory, exist_ok=True)
+                with open(speciesListFile + ".part", "w") as f:
+                    json.dump(speciesList, f)
+                os.replace(speciesListFile + ".part", speciesListFile)
+
+        # The list also has regional and subpopulation assessments under the same scientific name; only the global
+        # assessment (population is null) is indexed
+        return dict((species["scientific_name"].lower(), species) for species in speciesList
+                    if species.get("population") is None)
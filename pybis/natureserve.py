@@ -1,3 +1,12 @@
+from pybis.bis import LRUCache
+
+# Scientific name -> species record (or None) from the NatureServe name search
+natureServeCache = LRUCache(20000)
+
+# Marks names that NatureServe has no record for, so misses are cached as well
+notFound = object()
+
+
 class Natureserve:
     def __init__(self):
         self.description = "Set of functions for working with the NatureServe APIs"
@@ -21,5 +30,92 @@ class Natureserve:
                     return validResult[0]
             else:
                 return natureServeDict["speciesList"]["species"]
-        
 
+
+    def species_element_to_dict(element):
+        # Same layout xmltodict produces: "@" attributes, "#text" for mixed text, lists for repeated tags
+        elementDict = {}
+        for key, value in element.attrib.items():
+            elementDict["@" + key.split("}")[-1]] = value
+        for child in element:
+            childKey = child.tag.split("}")[-1]
+            childValue = Natureserve.species_element_to_dict(child)
+            if childKey not in elementDict:
+                elementDict[childKey] = childValue
+            elif type(elementDict[childKey]) is list:
+                elementDict[childKey].append(childValue)
+            else:
+                elementDict[childKey] = [elementDict[childKey], childValue]
+        text = (element.text or "").strip()
+        if text:
+            if len(elementDict) == 0:
+                return text
+            elementDict["#text"] = text
+        return elementDict if len(elementDict) > 0 else None
+
+
+    def query_natureserve_streaming(scientificname, session=None):
+        import requests
+        import xml.etree.ElementTree as ET
+
+        natureServeSpeciesQueryBaseURL = "https://services.natureserve.org/idd/rest/v1/nationalSpecies/summary/nameSearch"
+        response = (session or requests).get(natureServeSpeciesQueryBaseURL, params={"nationCode":"US","name":scientificname}, stream=True)
+        try:
+            response.raise_for_status()
+        except:
+            response.close()
+            raise
+        response.raw.decode_content = True
+
+        # Parse species elements as they arrive and stop at the exact name match instead of building the whole document
+        firstSpecies = None
+        speciesCount = 0
+        try:
+            for event, element in ET.iterparse(response.raw, events=("end",)):
+                if element.tag.split("}")[-1] != "species":
+                    continue
+                speciesCount = speciesCount + 1
+                nameElement = next((c for c in element if c.tag.split("}")[-1] == "nationalScientificName"), None)
+                if nameElement is not None and nameElement.text == scientificname:
+                    return Natureserve.species_element_to_dict(element)
+                if speciesCount == 1:
+                    firstSpecies = Natureserve.species_element_to_dict(element)
+                element.clear()
+        finally:
+            response.close()
+
+        # Like query_natureserve, a single result is returned even when its name isn't an exact match
+        if speciesCount == 1:
+            return firstSpecies
+        return None
+
+
+    def query_natureserve_many(scientificnames, maxWorkers=8):
+        import requests
+        from concurrent.futures import ThreadPoolExecutor
+
+        names = list(dict.fromkeys(scientificnames))
+        results = {}
+        for name in names:
+            cached = natureServeCache.get(name)
+            if cached is not None:
+                results[name] = None if cached is notFound else cached
+
+        session = requests.Session()
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=maxWorkers))
+
+        # A name whose request or parse fails comes back as {"name": ..., "error": ...} and isn't cached, so one bad
+        # response doesn't sink the batch and the name is tried again next time
+        def query(name):
+            try:
+                species = Natureserve.query_natureserve_streaming(name, session)
+            except Exception as e:
+                return {"name":name,"error":str(e)}
+            natureServeCache.put(name, notFound if species is None else species)
+            return species
+
+        toQuery = [name for name in names if name not in results]
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            results.update(zip(toQuery, executor.map(query, toQuery)))
+
+        return results
@@ -1,9 +1,91 @@
+import io
+
+
+class FtpRangeReader(io.RawIOBase):
+    def __init__(self, ftp, fileName, blockSize=1048576):
+        # Seekable, read-only view of a file on an FTP server. Each block is fetched with a REST offset,
+        # so a ZipFile on top of it only pulls the central directory and the members it actually reads.
+        self.description = "Seekable reader for a remote FTP file"
+        self.ftp = ftp
+        self.fileName = fileName
+        self.blockSize = blockSize
+        self.ftp.voidcmd('TYPE I')
+        self.size = self.ftp.size(fileName)
+        self.position = 0
+        self.blockStart = None
+        self.block = b''
+        self.bytesFetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position = self.position + offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def fetch_block(self, start, length):
+        from ftplib import error_temp, error_perm, error_reply
+
+        conn = self.ftp.transfercmd('RETR ' + self.fileName, rest=start)
+        chunks = []
+        received = 0
+        try:
+            while received < length:
+                chunk = conn.recv(min(65536, length - received))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                received = received + len(chunk)
+        finally:
+            conn.close()
+        # Closing the data connection early makes most servers report an aborted transfer, which is expected here
+        try:
+            self.ftp.voidresp()
+        except (error_temp, error_perm, error_reply):
+            pass
+        self.bytesFetched = self.bytesFetched + received
+        return b''.join(chunks)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        if size <= 0:
+            return b''
+
+        blockEnd = self.blockStart + len(self.block) if self.blockStart is not None else None
+        if self.blockStart is None or self.position < self.blockStart or self.position + size > blockEnd:
+            self.blockStart = self.position
+            self.block = self.fetch_block(self.position, max(size, self.blockSize))
+
+        offset = self.position - self.blockStart
+        data = self.block[offset:offset + size]
+        self.position = self.position + len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
 class Nhd:
 
     def build_nhd_repo_directory_listing(sbitemid, ftpurl):
         from ftplib import FTP
         from datetime import datetime
-        from time import strptime
+        from pybis.nhd import Nhd as nhd
 
         ftpSite = ftpurl.replace('ftp://', '').split('/')[0]
         ftpDir = '/'.join(ftpurl.replace('ftp://', '').split('/')[1:])
@@ -26,43 +108,212 @@ class Nhd:
 
         nhdRepositoryListing['File Catalog'] = []
         for line in ftpDirList[2:]:
-            dirList = list(filter(None, line.split(' ')))
+            thisItem = nhd.parse_ftp_dir_line(line)
+            nhdRepositoryListing['File Catalog'].append(nhd.parse_nhd_file_name(thisItem))
 
-            thisItem = {}
-            thisItem['File Name'] = dirList[-1]
-            thisItem['File Size'] = dirList[4]
-            thisItem['File Date'] = datetime(year=int(dirList[7]), month=strptime(dirList[5], '%b').tm_mon,
-                                             day=int(dirList[6])).isoformat()
+        return nhdRepositoryListing
 
-            if thisItem['File Name'][0:7] == 'NHDPlus':
 
-                filePartToWork = thisItem['File Name'].split('.')[0]
-                fileStartStuff = filePartToWork.split('_')[0].replace('NHDPlus', '').split('V')
-                thisItem['NHD Version'] = fileStartStuff[1]
+    def parse_ftp_dir_line(line):
+        from datetime import datetime
+        from time import strptime
 
-                possibleNHDRegion = fileStartStuff[0]
-                try:
-                    if possibleNHDRegion[0].isdigit() and possibleNHDRegion[1].isdigit():
-                        thisItem['NHD Processing Unit'] = possibleNHDRegion
-                except:
-                    pass
+        # Split once on whitespace; the ninth column is the file name and may itself contain spaces
+        dirList = line.split(None, 8)
 
-                possibleFileVersion = filePartToWork.split('_')[1]
-                if possibleFileVersion[0].isdigit() and possibleFileVersion[1].isdigit():
-                    thisItem['File Version'] = possibleFileVersion
+        # Files from the last six months show a time instead of a year. That date is never in the future, so one
+        # that would be (a December file listed in January) belongs to the previous year.
+        fileMonth = strptime(dirList[5], '%b').tm_mon
+        fileDay = int(dirList[6])
+        if ':' in dirList[7]:
+            now = datetime.now()
+            fileHour, fileMinute = [int(part) for part in dirList[7].split(':')]
+            fileDate = datetime(year=now.year, month=fileMonth, day=fileDay, hour=fileHour, minute=fileMinute)
+            if fileDate > now:
+                fileDate = fileDate.replace(year=now.year - 1)
+        else:
+            fileDate = datetime(year=int(dirList[7]), month=fileMonth, day=fileDay)
 
-                thisItem['File Type'] = '_'.join(filePartToWork.split('_')[2:])
+        thisItem = {}
+        thisItem['File Name'] = dirList[8]
+        thisItem['File Size'] = dirList[4]
+        thisItem['File Date'] = fileDate.isoformat()
+        return thisItem
 
-            nhdRepositoryListing['File Catalog'].append(thisItem)
 
-        return nhdRepositoryListing
+    def parse_nhd_file_name(thisItem):
+        if thisItem['File Name'][0:7] == 'NHDPlus':
+
+            filePartToWork = thisItem['File Name'].split('.')[0]
+            fileParts = filePartToWork.split('_')
+            fileStartStuff = fileParts[0].replace('NHDPlus', '').split('V')
+            thisItem['NHD Version'] = fileStartStuff[1]
+
+            possibleNHDRegion = fileStartStuff[0]
+            try:
+                if possibleNHDRegion[0].isdigit() and possibleNHDRegion[1].isdigit():
+                    thisItem['NHD Processing Unit'] = possibleNHDRegion
+            except:
+                pass
+
+            possibleFileVersion = fileParts[1]
+            if possibleFileVersion[0].isdigit() and possibleFileVersion[1].isdigit():
+                thisItem['File Version'] = possibleFileVersion
+
+            thisItem['File Type'] = '_'.join(fileParts[2:])
+
+        return thisItem
+
+
+    def build_nhd_repo_catalog(sbitemid, ftpurls, maxConnections=4, catalogFile=None):
+        from ftplib import FTP, error_perm
+        from datetime import datetime
+        from queue import Queue, Empty
+        from threading import Thread, Lock
+        import json
+        import os
+        from pybis.nhd import Nhd as nhd
+
+        ftpSites = set(url.replace('ftp://', '').split('/')[0] for url in ftpurls)
+        if len(ftpSites) != 1:
+            raise Exception("All FTP directories in a catalog must be on the same server")
+        ftpSite = ftpSites.pop()
+        ftpDirs = ['/' + '/'.join(url.replace('ftp://', '').split('/')[1:]) for url in ftpurls]
+
+        # MLSD gives a full timestamp but a LIST line for an older file only has the day, so file dates are kept to
+        # the day; otherwise a worker switching listing method would flag every file as changed
+        def file_date(isoDate):
+            return isoDate[0:10]
+
+        # The previous catalog, if there is one, is used to flag new and changed files
+        previousFiles = {}
+        if catalogFile is not None and os.path.exists(catalogFile):
+            with open(catalogFile) as f:
+                for item in json.load(f)['File Catalog']:
+                    previousFiles[(item['FTP Directory'], item['File Name'])] = item
+
+        dirQueue = Queue()
+        for ftpDir in ftpDirs:
+            dirQueue.put(ftpDir)
+
+        fileCatalog = []
+        errors = []
+        crawledDirs = set()
+        catalogLock = Lock()
+
+        def list_directory(ftp, useMLSD):
+            items = []
+            if useMLSD:
+                for fileName, facts in ftp.mlsd(facts=['type', 'size', 'modify']):
+                    if facts.get('type') != 'file':
+                        continue
+                    items.append({'File Name': fileName, 'File Size': facts.get('size'),
+                                  'File Date': file_date(datetime.strptime(facts['modify'][0:14], '%Y%m%d%H%M%S').isoformat())})
+            else:
+                ftpDirList = []
+                ftp.dir(ftpDirList.append)
+                for line in ftpDirList:
+                    if line.startswith('total') or line.startswith('d'):
+                        continue
+                    thisItem = nhd.parse_ftp_dir_line(line)
+                    thisItem['File Date'] = file_date(thisItem['File Date'])
+                    items.append(thisItem)
+            return items
+
+        def crawl():
+            # Each worker holds one FTP connection and reuses it for every directory it takes off the queue
+            ftp = None
+            useMLSD = True
+            try:
+                while True:
+                    try:
+                        ftpDir = dirQueue.get_nowait()
+                    except Empty:
+                        break
+                    try:
+                        if ftp is None:
+                            ftp = FTP(ftpSite)
+                            ftp.login()
+                        ftp.cwd(ftpDir)
+                        try:
+                            items = list_directory(ftp, useMLSD)
+                        except error_perm:
+                            if not useMLSD:
+                                raise
+                            useMLSD = False
+                            items = list_directory(ftp, useMLSD)
+                    except Exception as e:
+                        with catalogLock:
+                            errors.append({'FTP Directory': ftpDir, 'Error': str(e)})
+                        # The session may be dead after an error, so the next directory gets a fresh connection
+                        if ftp is not None:
+                            try:
+                                ftp.close()
+                            except Exception:
+                                pass
+                            ftp = None
+                        continue
+
+                    for thisItem in items:
+                        thisItem['FTP Directory'] = ftpDir
+                        nhd.parse_nhd_file_name(thisItem)
+                        previous = previousFiles.get((ftpDir, thisItem['File Name']))
+                        if previous is None:
+                            thisItem['Change Status'] = 'New'
+                        elif (previous['File Size'], file_date(previous['File Date'])) != \
+                                (thisItem['File Size'], thisItem['File Date']):
+                            thisItem['Change Status'] = 'Changed'
+                        else:
+                            thisItem['Change Status'] = 'Unchanged'
+                    with catalogLock:
+                        fileCatalog.extend(items)
+                        crawledDirs.add(ftpDir)
+            finally:
+                if ftp is not None:
+                    try:
+                        ftp.quit()
+                    except Exception:
+                        ftp.close()
+
+        workers = [Thread(target=crawl) for i in range(min(maxConnections, len(ftpDirs)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        seenFiles = set((item['FTP Directory'], item['File Name']) for item in fileCatalog)
+
+        # Directories that could not be listed keep their previous entries, so a failed run doesn't wipe the catalog
+        for key, item in previousFiles.items():
+            if key[0] in ftpDirs and key[0] not in crawledDirs:
+                carriedItem = dict(item)
+                carriedItem['Change Status'] = 'Not Listed'
+                fileCatalog.append(carriedItem)
+
+        nhdRepositoryCatalog = {}
+        nhdRepositoryCatalog['Source ScienceBase Item'] = sbitemid
+        nhdRepositoryCatalog['FTP Server'] = ftpSite
+        nhdRepositoryCatalog['FTP Directories'] = ftpDirs
+        nhdRepositoryCatalog['Date Retrieved'] = datetime.now().isoformat()
+        nhdRepositoryCatalog['File Catalog'] = sorted(fileCatalog, key=lambda item: (item['FTP Directory'], item['File Name']))
+        nhdRepositoryCatalog['Changed Files'] = [item for item in nhdRepositoryCatalog['File Catalog']
+                                                 if item['Change Status'] in ('New', 'Changed')]
+        nhdRepositoryCatalog['Removed Files'] = [{'FTP Directory': key[0], 'File Name': key[1]} for key in previousFiles
+                                                 if key[0] in crawledDirs and key not in seenFiles]
+        nhdRepositoryCatalog['Errors'] = errors
+
+        if catalogFile is not None:
+            with open(catalogFile, 'w') as f:
+                json.dump(nhdRepositoryCatalog, f, indent=2)
+
+        return nhdRepositoryCatalog
 
 
     def nhdv1_flowline_extract_filename(sourceFileName):
         return sourceFileName.split('.')[0]+'_FlowlineExtract.zip'
 
 
-    def build_flowline_extract(sourcePath):
+    def build_flowline_extract(sourcePath, streaming=False, workDir=''):
         from ftplib import FTP
         from urllib.parse import urlparse
         import os
@@ -73,30 +324,112 @@ class Nhd:
         parsedPath = urlparse(sourcePath)
 
         sourceFile = parsedPath.path.split('/')[-1]
-        extractFile = nhd.nhdv1_flowline_extract_filename(sourceFile)
+        localSourceFile = os.path.join(workDir, sourceFile)
+        extractFile = os.path.join(workDir, nhd.nhdv1_flowline_extract_filename(sourceFile))
 
         ftp = FTP(parsedPath.netloc)
         ftp.login()
 
+        if streaming:
+            # Read the archive in place over FTP and copy the NHDFlowline members straight into the extract
+            try:
+                with ftp:
+                    ftp.cwd('/'.join(parsedPath.path.split('/')[:-1]))
+                    remoteFile = FtpRangeReader(ftp, sourceFile)
+                    with ZipFile(remoteFile) as theZip, ZipFile(extractFile, mode='w') as zf:
+                        extractFileList = [n for n in theZip.namelist() if
+                                           n.split('/')[-1].split('.')[0].lower() == 'nhdflowline']
+                        for fn in extractFileList:
+                            # The size isn't known up front when writing through open(), so allow for members
+                            # over 2 GiB the way zf.write does on the download path
+                            with theZip.open(fn) as source, \
+                                    zf.open(fn.split('/')[-1], mode='w', force_zip64=True) as target:
+                                shutil.copyfileobj(source, target, 1048576)
+            except:
+                if os.path.exists(extractFile):
+                    os.remove(extractFile)
+                raise
+
+            return extractFile
+
         with ftp:
             ftp.cwd('/'.join(parsedPath.path.split('/')[:-1]))
-            with open(sourceFile, 'wb') as zf:
+            with open(localSourceFile, 'wb') as zf:
                 ftp.retrbinary('RETR ' + sourceFile, zf.write)
 
 
-        with ZipFile(sourceFile) as theZip:
+        with ZipFile(localSourceFile) as theZip:
             extractFileList = [n for n in theZip.namelist() if
                                n.split('/')[-1].split('.')[0].lower() == 'nhdflowline']
             for fn in extractFileList:
-                theZip.extract(fn)
+                theZip.extract(fn, workDir)
 
         zf = ZipFile(extractFile, mode='w')
         for fn in extractFileList:
-            zf.write(fn, fn.split('/')[-1])
-            os.remove(fn)
+            zf.write(os.path.join(workDir, fn), fn.split('/')[-1])
+            os.remove(os.path.join(workDir, fn))
         zf.close()
 
-        os.remove(sourceFile)
-        shutil.rmtree(extractFileList[0].split('/')[0], ignore_errors=True)
+        os.remove(localSourceFile)
+        shutil.rmtree(os.path.join(workDir, extractFileList[0].split('/')[0]), ignore_errors=True)
+
+        return extractFile
+
+
+    def build_flowline_extracts(nhdRepositoryListing, outputDir='.', fileType='NHDSnapshot', maxConnections=4,
+                                streaming=False, manifestFile=None):
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from datetime import datetime
+        from threading import Lock
+        import json
+        import os
+        import shutil
+        import tempfile
+        from pybis.nhd import Nhd as nhd
+
+        # Works from either build_nhd_repo_directory_listing or build_nhd_repo_catalog output
+        sourceItems = [item for item in nhdRepositoryListing['File Catalog'] if fileType in item.get('File Type', '')]
+
+        os.makedirs(outputDir, exist_ok=True)
+        manifest = {'FTP Server': nhdRepositoryListing['FTP Server'], 'Date Started': datetime.now().isoformat(),
+                    'Extracts': []}
+        manifestLock = Lock()
+
+        def source_path(item):
+            ftpDir = item.get('FTP Directory', nhdRepositoryListing.get('FTP Directory', '')).strip('/')
+            return 'ftp://' + nhdRepositoryListing['FTP Server'] + '/' + ftpDir + '/' + item['File Name']
+
+        def build(item):
+            sourcePath = source_path(item)
+
+            # Every job works in its own scratch directory so parallel runs can't clash on file names
+            workDir = tempfile.mkdtemp(prefix='nhd_extract_', dir=outputDir)
+            try:
+                extractFile = nhd.build_flowline_extract(sourcePath, streaming=streaming, workDir=workDir)
+                outputFile = os.path.join(outputDir, os.path.basename(extractFile))
+                os.replace(extractFile, outputFile)
+                return {'Source Path': sourcePath, 'Extract File': outputFile,
+                        'NHD Processing Unit': item.get('NHD Processing Unit'), 'Success': True,
+                        'Date Completed': datetime.now().isoformat()}
+            finally:
+                shutil.rmtree(workDir, ignore_errors=True)
+
+        def record(extract):
+            # Rewrite the manifest as each extract completes so an interrupted run still leaves a usable record
+            with manifestLock:
+                manifest['Extracts'].append(extract)
+                if manifestFile is not None:
+                    with open(manifestFile, 'w') as f:
+                        json.dump(manifest, f, indent=2)
+
+        with ThreadPoolExecutor(max_workers=maxConnections) as executor:
+            futures = dict((executor.submit(build, item), item) for item in sourceItems)
+            for future in as_completed(futures):
+                try:
+                    record(future.result())
+                except Exception as e:
+                    record({'Source Path': source_path(futures[future]),
+                            'NHD Processing Unit': futures[future].get('NHD Processing Unit'), 'Success': False,
+                            'Error': str(e), 'Date Completed': datetime.now().isoformat()})
 
-        return extractFile
\ No newline at end of file
+        return manifest
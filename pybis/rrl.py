@@ -1,3 +1,9 @@
+from pybis.bis import RateLimiter
+
+# Shared by every Scopus call in the process so concurrent jobs stay within the key's request rate
+scopusLimiter = RateLimiter(5)
+
+
 class ResearchReferenceLibrary:
     def __init__(self):
         self.description = 'Set of functions for working with the Research Reference Library'
@@ -29,11 +35,82 @@ class ResearchReferenceLibrary:
             else:
                 newSources = existingRecord["Sources"]
                 newSources.append({"source":source,"date":datetime.utcnow().isoformat()})
-                registryContainer.update({"_id":existingSource["_id"]},{"$set":{"Sources":newSources}})
+                registryContainer.update({"_id":existingRecord["_id"]},{"$set":{"Sources":newSources}})
                 result = {"status":"ok","_id":existingRecord["_id"],"message":"Citation string already registered; new source added."}
 
         return result
 
+
+    def register_citations(registryContainer,citations,source):
+        import hashlib
+        from datetime import datetime
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+
+        # Citations can be plain strings or (citationString, url) pairs
+        citationList = [(c, None) if isinstance(c, str) else tuple(c) for c in citations]
+        if len(citationList) == 0:
+            return []
+
+        hashIDs = [hashlib.md5(citationString.encode()).hexdigest() for citationString, url in citationList]
+        dateRegistered = datetime.utcnow().isoformat()
+
+        # The filter only matches records that don't list this source yet, so an existing record gets the source pushed,
+        # a missing record is inserted, and a record that already has the source fails on the duplicate _id
+        operations = []
+        for hash_id, (citationString, url) in zip(hashIDs, citationList):
+            newCitation = {"Citation String":citationString}
+            if url is not None:
+                newCitation["url"] = url
+            operations.append(UpdateOne(
+                {"_id":hash_id,"Sources.source":{"$ne":source}},
+                {"$setOnInsert":newCitation,"$push":{"Sources":{"source":source,"date":dateRegistered}}},
+                upsert=True
+            ))
+
+        def write(indexes):
+            try:
+                bulkResult = registryContainer.bulk_write([operations[i] for i in indexes], ordered=False).bulk_api_result
+            except BulkWriteError as e:
+                bulkResult = e.details
+            # Map positions in this write back to positions in the citation list
+            upserted = set(indexes[u["index"]] for u in bulkResult.get("upserted", []))
+            duplicates = set(indexes[w["index"]] for w in bulkResult.get("writeErrors", []) if w["code"] == 11000)
+            failed = dict((indexes[w["index"]], w["errmsg"]) for w in bulkResult.get("writeErrors", []) if w["code"] != 11000)
+            return upserted, duplicates, failed
+
+        insertedIndexes, duplicateIndexes, failedIndexes = write(list(range(len(operations))))
+
+        # A duplicate _id also happens when another registrant inserts the same new citation first, under a different
+        # source. The server won't retry an upsert whose filter has the $ne predicate, so retry once here: the record
+        # now exists, and the retry either pushes this source or fails again because the source really is listed.
+        if len(duplicateIndexes) > 0:
+            retryInserted, duplicateIndexes, retryFailed = write(sorted(duplicateIndexes))
+            insertedIndexes.update(retryInserted)
+            failedIndexes.update(retryFailed)
+
+        # Only report "already registered" where the record really lists the source; anything else is still racing
+        if len(duplicateIndexes) > 0:
+            registeredIDs = set(doc["_id"] for doc in registryContainer.find(
+                {"_id":{"$in":[hashIDs[i] for i in duplicateIndexes]},"Sources.source":source}, {"_id":1}))
+            for index in list(duplicateIndexes):
+                if hashIDs[index] not in registeredIDs:
+                    duplicateIndexes.discard(index)
+                    failedIndexes[index] = "Citation string could not be registered for this source because of a concurrent write; try again."
+
+        results = []
+        for index, hash_id in enumerate(hashIDs):
+            if index in insertedIndexes:
+                results.append({"status":"ok","_id":hash_id,"message":"New citation registered."})
+            elif index in duplicateIndexes:
+                results.append({"status":"failed","_id":hash_id,"message":"Citation string was already registered for this source."})
+            elif index in failedIndexes:
+                results.append({"status":"failed","_id":hash_id,"message":failedIndexes[index]})
+            else:
+                results.append({"status":"ok","_id":hash_id,"message":"Citation string already registered; new source added."})
+
+        return results
+
     
     def ref_link_data(url):
         import requests
@@ -50,6 +127,60 @@ class ResearchReferenceLibrary:
         return response
     
     
+    def check_links(urls,linkContainer=None,maxAgeDays=7,maxWorkers=16,timeout=(5,30)):
+        import requests
+        import threading
+        from datetime import datetime, timedelta
+        from concurrent.futures import ThreadPoolExecutor
+        from pymongo import ReplaceOne
+
+        urlList = list(dict.fromkeys(urls))
+
+        # Links checked within maxAgeDays are taken from the store instead of being checked again
+        results = {}
+        if linkContainer is not None:
+            cutoffDate = (datetime.utcnow() - timedelta(days=maxAgeDays)).isoformat()
+            for linkDoc in linkContainer.find({"_id":{"$in":urlList},"Date Checked":{"$gte":cutoffDate}}):
+                results[linkDoc.pop("_id")] = linkDoc
+
+        # Each worker thread keeps its own session so connections to the same host are reused
+        threadData = threading.local()
+
+        def get_session():
+            if not hasattr(threadData, "session"):
+                threadData.session = requests.Session()
+                threadData.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=4))
+                threadData.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=4))
+            return threadData.session
+
+        def check(url):
+            linkDoc = {"Date Checked":datetime.utcnow().isoformat(),"Link Checked":url,"Success":False}
+            session = get_session()
+            try:
+                response = session.head(url, allow_redirects=True, timeout=timeout)
+                # Plenty of servers don't implement HEAD properly, so fall back to a GET without reading the body
+                if response.status_code >= 400:
+                    response = session.get(url, allow_redirects=True, timeout=timeout, stream=True)
+                    response.close()
+                linkDoc["Status Code"] = response.status_code
+                linkDoc["Final URL"] = response.url
+                linkDoc["Content Type"] = response.headers.get("Content-Type")
+                linkDoc["Success"] = response.status_code < 400
+            except requests.exceptions.RequestException as e:
+                linkDoc["Error"] = str(e)
+            return linkDoc
+
+        toCheck = [url for url in urlList if url not in results]
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            checked = dict(zip(toCheck, executor.map(check, toCheck)))
+        results.update(checked)
+
+        if linkContainer is not None and len(checked) > 0:
+            linkContainer.bulk_write([ReplaceOne({"_id":url}, linkDoc, upsert=True) for url, linkDoc in checked.items()], ordered=False)
+
+        return results
+
+
     def lookup_crossref(citation,threshold=60):
         import requests
         from datetime import datetime
@@ -71,6 +202,107 @@ class ResearchReferenceLibrary:
         return crossRefDoc
     
    
+    def lookup_crossref_many(citations,threshold=60,cacheContainer=None,maxWorkers=4,requestsPerSecond=10,recheckUnmatched=True):
+        import hashlib
+        import requests
+        from datetime import datetime, timezone
+        from email.utils import parsedate_to_datetime
+        from concurrent.futures import ThreadPoolExecutor
+        from pymongo import ReplaceOne
+        from pybis.bis import RateLimiter
+
+        crossRefWorksAPI = "https://api.crossref.org/works"
+        mailTo = "bcb@usgs.gov"
+
+        citationList = list(citations)
+        hashIDs = [hashlib.md5(c.encode()).hexdigest() for c in citationList]
+
+        # Results are cached under the same hash register_citation uses for the citation string
+        results = {}
+        if cacheContainer is not None:
+            for cachedDoc in cacheContainer.find({"_id":{"$in":list(set(hashIDs))}}):
+                if cachedDoc["Success"] or not recheckUnmatched:
+                    results[cachedDoc.pop("_id")] = cachedDoc
+
+        limiter = RateLimiter(requestsPerSecond)
+        session = requests.Session()
+        session.headers.update({"User-Agent":"pybis (mailto:"+mailTo+")"})
+
+        def retry_after(response, default):
+            # Retry-After is either a number of seconds or an HTTP date
+            value = response.headers.get("Retry-After")
+            if value is None:
+                return default
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass
+            try:
+                retryDate = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return default
+            if retryDate is None:
+                return default
+            return max(0.0, (retryDate - datetime.now(timezone.utc)).total_seconds())
+
+        def lookup(citation):
+            crossRefDoc = {"Success":False,"Date Checked":datetime.utcnow().isoformat()}
+            # One bad response shouldn't take the rest of the batch down with it, so failures become an uncached Error
+            try:
+                return lookup_citation(citation, crossRefDoc)
+            except Exception as e:
+                crossRefDoc["Error"] = "%s: %s" % (type(e).__name__, e)
+                return crossRefDoc
+
+        def lookup_citation(citation, crossRefDoc):
+            params = {"mailto":mailTo,"query.bibliographic":citation,"rows":1}
+            crossRefDoc["Query URL"] = requests.Request("GET", crossRefWorksAPI, params=params).prepare().url
+
+            for attempt in range(5):
+                limiter.wait()
+                try:
+                    response = session.get(crossRefWorksAPI, params=params, timeout=(10, 60))
+                except requests.exceptions.RequestException as e:
+                    crossRefDoc["Error"] = str(e)
+                    return crossRefDoc
+                if response.status_code == 429 or response.status_code >= 500:
+                    limiter.backoff(retry_after(response, 2 ** attempt))
+                    continue
+                break
+            else:
+                crossRefDoc["Error"] = "HTTP %d" % response.status_code
+                return crossRefDoc
+
+            try:
+                crossRefResults = response.json()
+            except ValueError:
+                crossRefDoc["Error"] = "HTTP %d" % response.status_code
+                return crossRefDoc
+
+            if crossRefResults["status"] != "failed" and "items" in crossRefResults["message"].keys() and len(crossRefResults["message"]["items"]) > 0 and crossRefResults["message"]["items"][0]["score"] >= threshold:
+                crossRefDoc["Success"] = True
+                crossRefDoc["Score"] = crossRefResults["message"]["items"][0]["score"]
+                crossRefDoc["Record"] = crossRefResults["message"]["items"][0]
+
+            return crossRefDoc
+
+        toQuery = {}
+        for hash_id, citation in zip(hashIDs, citationList):
+            if hash_id not in results:
+                toQuery[hash_id] = citation
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            queried = dict(zip(toQuery.keys(), executor.map(lookup, toQuery.values())))
+        results.update(queried)
+
+        # Requests that errored out are not cached so they are tried again next time
+        cacheOperations = [ReplaceOne({"_id":hash_id}, crossRefDoc, upsert=True) for hash_id, crossRefDoc in queried.items() if "Error" not in crossRefDoc]
+        if cacheContainer is not None and len(cacheOperations) > 0:
+            cacheContainer.bulk_write(cacheOperations, ordered=False)
+
+        return [results[hash_id] for hash_id in hashIDs]
+
+
     def lookup_scopus_by_doi(doi):
         import requests
         import os
@@ -85,3 +317,140 @@ class ResearchReferenceLibrary:
 
         result = requests.get("https://api.elsevier.com/content/abstract/citations?apiKey="+os.environ["SCOPUSKEY"]+"&doi="+doi, headers={"Accept":"application/json"}).json()
         return result
+
+
+    def scopus_get(session, limiter, url, params):
+        # Wait for the shared limiter, retry on throttling, and stop outright when the key's quota is used up. Any
+        # other error status raises requests.HTTPError rather than passing the error body off as an empty result.
+        for attempt in range(5):
+            limiter.wait()
+            response = session.get(url, params=params, timeout=(10, 60))
+            if response.status_code == 429:
+                if response.headers.get("X-RateLimit-Remaining") == "0":
+                    raise Exception("Scopus API quota exhausted; it resets at %s" % response.headers.get("X-RateLimit-Reset"))
+                limiter.backoff(2 ** attempt)
+                continue
+            response.raise_for_status()
+            return response.json()
+
+        raise Exception("Scopus API kept throttling requests to %s" % url)
+
+
+    def scopus_doi_clause(doi):
+        # Quoted so DOIs with parentheses, like the 10.1002/(SICI)... form, don't break the OR'd query
+        return 'doi("' + doi.replace('\\', '\\\\').replace('"', '\\"') + '")'
+
+
+    def lookup_scopus_by_doi_many(dois,batchSize=25,limiter=None,onBatch=None,onBatchError=None):
+        import requests
+        import os
+        from pybis.rrl import ResearchReferenceLibrary as rrl
+
+        # Scopus search takes OR'd doi() clauses, so each request covers a batch of DOIs
+        limiter = limiter or scopusLimiter
+        session = requests.Session()
+        session.headers.update({"Accept":"application/json","X-ELS-APIKey":os.environ["SCOPUSKEY"]})
+
+        # onBatch, if given, is called with each batch's DOI -> entry dict as it completes, so callers can save
+        # results before a later batch runs into the quota. onBatchError, if given, is called with (batch, error)
+        # for a batch whose request failed, and the run moves on; without it the error is raised. A batch Scopus
+        # rejects as a bad request is retried one DOI at a time so a single odd DOI only costs itself. Key
+        # problems (401/403) always stop the run since every later batch would fail the same way.
+        doiList = list(dict.fromkeys(dois))
+        batches = [doiList[start:start+batchSize] for start in range(0, len(doiList), batchSize)]
+        results = {}
+        while len(batches) > 0:
+            batch = batches.pop(0)
+            try:
+                searchResults = rrl.scopus_get(session, limiter, "https://api.elsevier.com/content/search/scopus",
+                                               {"query":" OR ".join(rrl.scopus_doi_clause(doi) for doi in batch),"count":len(batch)})
+            except requests.exceptions.HTTPError as e:
+                statusCode = e.response.status_code if e.response is not None else None
+                if statusCode == 400 and len(batch) > 1:
+                    batches[0:0] = [[doi] for doi in batch]
+                    continue
+                if onBatchError is None or statusCode in (401, 403):
+                    raise
+                onBatchError(batch, e)
+                continue
+            batchResults = dict((doi, None) for doi in batch)
+            batchLookup = dict((doi.lower(), doi) for doi in batch)
+            for entry in searchResults.get("search-results", {}).get("entry", []):
+                entryDOI = entry.get("prism:doi")
+                if entryDOI is not None and entryDOI.lower() in batchLookup:
+                    batchResults[batchLookup[entryDOI.lower()]] = entry
+            results.update(batchResults)
+            if onBatch is not None:
+                onBatch(batchResults)
+
+        return results
+
+
+    def scopus_citations_by_doi_many(dois,batchSize=25,limiter=None):
+        import requests
+        import os
+        from pybis.rrl import ResearchReferenceLibrary as rrl
+
+        # The citations overview takes a comma separated list of DOIs
+        limiter = limiter or scopusLimiter
+        session = requests.Session()
+        session.headers.update({"Accept":"application/json","X-ELS-APIKey":os.environ["SCOPUSKEY"]})
+
+        doiList = list(dict.fromkeys(dois))
+        results = []
+        for start in range(0, len(doiList), batchSize):
+            batch = doiList[start:start+batchSize]
+            results.append(rrl.scopus_get(session, limiter, "https://api.elsevier.com/content/abstract/citations",
+                                          {"doi":",".join(batch)}))
+
+        return results
+
+
+    def refresh_scopus_citation_counts(referenceContainer,doiField="doi",maxAgeDays=30,maxDOIs=5000,batchSize=25):
+        from datetime import datetime, timedelta
+        from pymongo import UpdateOne
+        from pybis.rrl import ResearchReferenceLibrary as rrl
+
+        # Only records that were never checked or were checked more than maxAgeDays ago are refreshed, oldest first,
+        # and maxDOIs caps the run to what fits in the API key's quota
+        cutoffDate = (datetime.utcnow() - timedelta(days=maxAgeDays)).isoformat()
+        staleRecords = referenceContainer.find(
+            {doiField:{"$nin":[None,""]},"$or":[{"Scopus Citations.Date Checked":{"$lt":cutoffDate}},{"Scopus Citations":{"$exists":False}}]},
+            {doiField:1}
+        ).sort("Scopus Citations.Date Checked", 1).limit(maxDOIs)
+
+        recordIDs = {}
+        for record in staleRecords:
+            if isinstance(record.get(doiField), str) and record[doiField] != "":
+                recordIDs.setdefault(record[doiField], []).append(record["_id"])
+
+        summary = {"checked":0,"found":0,"failed":0}
+        if len(recordIDs) == 0:
+            return summary
+
+        # Each batch is written as soon as it comes back, so running out of quota keeps everything paid for so far
+        def save_batch(batchResults):
+            dateChecked = datetime.utcnow().isoformat()
+            updates = []
+            for doi, entry in batchResults.items():
+                scopusCitations = {"Date Checked":dateChecked,"Success":entry is not None}
+                if entry is not None:
+                    summary["found"] = summary["found"] + 1
+                    scopusCitations["Citation Count"] = int(entry.get("citedby-count", 0))
+                    scopusCitations["Scopus ID"] = entry.get("dc:identifier")
+                for recordID in recordIDs[doi]:
+                    updates.append(UpdateOne({"_id":recordID},{"$set":{"Scopus Citations":scopusCitations}}))
+            referenceContainer.bulk_write(updates, ordered=False)
+            summary["checked"] = summary["checked"] + len(batchResults)
+
+        # Failed batches are left unwritten so their records stay stale and are tried again on the next run
+        def skip_batch(batch, error):
+            summary["failed"] = summary["failed"] + len(batch)
+            summary.setdefault("batch errors", []).append(str(error))
+
+        try:
+            rrl.lookup_scopus_by_doi_many(list(recordIDs.keys()), batchSize, onBatch=save_batch, onBatchError=skip_batch)
+        except Exception as e:
+            summary["error"] = str(e)
+
+        return summary
@@ -2,9 +2,19 @@ import requests
 import math
 import zipfile
 import os
+import json
+import hashlib
+import time
+import cProfile
+import pstats
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import sciencebasepy as pysb
-from osgeo import ogr, osr
+from osgeo import gdal, ogr, osr
 import shutil
+import tempfile
 
 """SFR pipeline tools.
 
@@ -21,8 +31,20 @@ POSTGIS_PORT
 DB_USERNAME
 PG_TO_ELASTIC
 API_TOKEN
+SFR_CACHE_DIRECTORY
 """
 
+# PGCLIENTENCODING is process wide, so concurrent loads take turns setting it and opening their connection
+pg_client_encoding_lock = threading.Lock()
+
+# Cached zip files in use by pipelines in this process (path -> number of users). evict_cache leaves them alone,
+# so a zip downloaded by one pipeline isn't removed while it waits for a load slot.
+cache_pins = {}
+cache_lock = threading.Lock()
+
+# One lock per cache key, so pipelines for the same zip wait for a single download instead of racing on it
+cache_download_locks = {}
+
 
 class SfrPipeline:
 
@@ -39,7 +61,27 @@ class SfrPipeline:
         'fit_to_bounding_box':False,
         'rounding_precision':None,
         'clean_up_geom':False,
-        'spatial_file_list': []
+        'spatial_file_list': [],
+        'work_directory':None,
+        'read_from_zip':False,
+        'stream_from_url':False,
+        'download_chunk_size':1048576,
+        'cache_directory':None,
+        'cache_max_bytes':10737418240,
+        'use_cached_item':False,
+        'stage_hook':None,
+        'profile_copy_features':False,
+        'batch_size':None,
+        'make_valid':False,
+        'index_target_batch_bytes':4194304,
+        'index_max_batch_size':1000,
+        'index_worst_case_factor':4,
+        'ogr_destination':None,
+        'reproject':False,
+        'attribute_filter':None,
+        'spatial_filter':None,
+        'load_mode':"full",
+        'feature_hash_column':"feature_hash"
     }
 
     def __init__(self, *initial_data, **kwargs):
@@ -53,11 +95,29 @@ class SfrPipeline:
         :param flip_coordinates: Some of the files with point geometry need to have their lat/lng's swapped
         :param custom_encoding: A significant number of the shape files in SB have needed a "LATIN1" encoding
         :param spatial_file_type: ".geojson" or ".shp" -- If nothing is specified, it will grab whatever one is there
-        :param batch_size: Number of geometries to be indexed at a time. 5 is safe, can be increases for point geoms
+        :param work_directory: Parent of the pipeline's private scratch directory for downloads and extracted files (defaults to the current directory)
+        :param batch_size: Number of geometries to be indexed at a time. If not set it is picked from the size of the loaded geometries
         :param make_valid: Run ST_MakeValid on the geoms before sending the geojson to ElasticSearch
         :param fit_to_bounding_box: This is for lat/lng geoms whose lat's fall outside the +-90.0
         :param rounding_precision: Round geom points to this level of precision when fixing
         :param clean_up_geom: Send the geoms through the rigorous cleanup process
+        :param read_from_zip: Open the spatial files straight from the downloaded zip with /vsizip/ instead of extracting
+        :param stream_from_url: Skip the download entirely and read the zip over HTTP with /vsizip/{/vsicurl/...}
+        :param download_chunk_size: Number of bytes to read per chunk when downloading the zip file
+        :param cache_directory: Keep downloaded zip files here and reuse them on later runs (defaults to SFR_CACHE_DIRECTORY)
+        :param cache_max_bytes: Evict the least recently used zip files once the cache grows past this size
+        :param use_cached_item: Use a cached zip for this item/zipfile_title without asking ScienceBase for the item JSON
+        :param stage_hook: Callable taking (stage, seconds, info) that is called as each pipeline stage finishes
+        :param profile_copy_features: Run copy_features under cProfile and keep the report in the pipeline stats
+        :param index_target_batch_bytes: Approximate WKB bytes of geometry to send to ElasticSearch per batch
+        :param index_max_batch_size: Upper limit on the picked batch size
+        :param index_worst_case_factor: Keep a batch of the largest geometry within this many times index_target_batch_bytes
+        :param ogr_destination: OGR data source to write to instead of Postgis, e.g. a GeoPackage for local benchmarking
+        :param reproject: Transform geometries from the source file's CRS to srid while copying features
+        :param attribute_filter: OGR SQL where clause; only matching source features are loaded
+        :param spatial_filter: WKT geometry or (minx, miny, maxx, maxy) in the source CRS; only intersecting features are loaded
+        :param load_mode: "full" to rebuild the table, or "delta" to only insert new/changed features and delete removed ones
+        :param feature_hash_column: Column holding the per-feature hash that delta loads compare against (written by full loads too)
         """
         self.description = "Set of functions for adding data to the SFR"
         for key in self.default_params:
@@ -67,9 +127,27 @@ class SfrPipeline:
                 setattr(self, key, dictionary[key])
         for key in kwargs:
             setattr(self, key, kwargs[key])
+        # Don't share the default list between pipelines
+        self.spatial_file_list = list(self.spatial_file_list)
         if self.item_id is None or self.table is None or self.srid is None or self.zipfile_title is None:
             raise Exception("Missing one of the required params: item_id, table, srid, or zipfile_title")
 
+        self.zip_file = None
+        self.zip_name = None
+        self.zip_cached = False
+        self.directory = None
+        self.extracted = False
+        self.scratch_directory = None
+        self.pinned_zip_file = None
+
+        if self.cache_directory is None:
+            self.cache_directory = os.getenv("SFR_CACHE_DIRECTORY")
+
+        self.transformations = {}
+        self.delta_hashes = None
+        self.delta_changes = None
+        self.reset_stats()
+
         self.pg2elastic = os.getenv("PG_TO_ELASTIC", "http://localhost:8090")
         self.api_token = os.getenv("API_TOKEN", "token1234")
 
@@ -79,6 +157,75 @@ class SfrPipeline:
         self.db_user = os.getenv("DB_USERNAME", "postgres")
         self.db_password = os.getenv("DB_PASSWORD", "admin")
 
+    def reset_stats(self):
+        """
+        Clear the stage timings and counters collected by the pipeline
+        :return: None
+        """
+        self.stats = {"stages": {}, "counters": {}, "profile": None}
+        self.profiler = None
+
+    def record_stage(self, stage, seconds, calls=1, **info):
+        """
+        Add a timing to a pipeline stage and pass it on to the stage hook
+        :param stage: Name of the stage (download, extract, copy_features, etc.)
+        :param seconds: Elapsed wall clock time
+        :param calls: Number of calls the elapsed time covers
+        :param info: Extra detail passed through to the stage hook
+        :return: None
+        """
+        entry = self.stats["stages"].setdefault(stage, {"calls": 0, "seconds": 0.0})
+        entry["calls"] = entry["calls"] + calls
+        entry["seconds"] = entry["seconds"] + seconds
+        if self.stage_hook is not None:
+            self.stage_hook(stage, seconds, info)
+
+    @contextmanager
+    def time_stage(self, stage, **info):
+        """
+        Time the enclosed block as a pipeline stage
+        :param stage: Name of the stage
+        :param info: Extra detail passed through to the stage hook
+        """
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record_stage(stage, time.perf_counter() - start, **info)
+
+    def increment_counter(self, counter, amount=1):
+        """
+        Increment one of the pipeline counters
+        :param counter: Name of the counter
+        :param amount: Amount to add
+        :return: None
+        """
+        self.stats["counters"][counter] = self.stats["counters"].get(counter, 0) + amount
+
+    def get_summary(self):
+        """
+        Summarize the stage timings and counters collected so far
+        :return: Dict with per-stage timings, counters, throughput and the optional cProfile report
+        """
+        summary = {
+            "item_id": self.item_id,
+            "table": self.schema + '.' + self.table,
+            "stages": dict(self.stats["stages"]),
+            "counters": dict(self.stats["counters"]),
+            "total_seconds": sum(s["seconds"] for name, s in self.stats["stages"].items()
+                                 if name != "fix_geometry")
+        }
+        copy_stage = self.stats["stages"].get("copy_features")
+        if copy_stage and copy_stage["seconds"] > 0:
+            summary["features_per_second"] = self.stats["counters"].get("features", 0) / copy_stage["seconds"]
+        if self.delta_changes is not None:
+            summary["delta_changes"] = self.delta_changes
+        if self.profiler is not None:
+            report = io.StringIO()
+            pstats.Stats(self.profiler, stream=report).sort_stats("cumulative").print_stats(25)
+            summary["profile"] = report.getvalue()
+        return summary
+
     def get_zip_file(self, item):
         """
         Grab the first zip file from the item. This can be improved moving forward
@@ -104,21 +251,22 @@ class SfrPipeline:
         :return: None
         """
         current = 0
-        chunk_size = 1024
-        printed = []
+        last_printed = -1
         print("Downloading file", flush=True)
 
         r = requests.get(url, stream=True)
+        r.raise_for_status()
 
         with open(self.zip_file, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                current = current + chunk_size
-                percent = math.floor(current / size * 100)
-                if percent not in printed and percent % 10 == 0:
-                    printed.append(percent)
-                    print("Current: %d%%" % percent, flush=True)
+            for chunk in r.iter_content(chunk_size=self.download_chunk_size):
                 if chunk:
                     f.write(chunk)
+                    current = current + len(chunk)
+                    self.increment_counter("bytes_downloaded", len(chunk))
+                    percent = math.floor(current / size * 100) // 10 * 10
+                    if percent > last_printed:
+                        last_printed = percent
+                        print("Current: %d%%" % percent, flush=True)
 
     def extract_zip_file(self):
         """
@@ -126,46 +274,221 @@ class SfrPipeline:
         :return: None
         """
         print("Extracting zip file", flush=True)
-        self.directory = self.zip_file[0:-4]
+        self.directory = os.path.join(self.get_scratch_directory(), self.zip_name[0:-4])
         zip_file = zipfile.ZipFile(self.zip_file, 'r')
         zip_file.extractall(self.directory)
         zip_file.close()
+        self.extracted = True
+
+    def get_scratch_directory(self):
+        """
+        Create the pipeline's scratch directory on first use. Each pipeline gets its own, so pipelines loading
+        tables from the same item don't download to or extract into the same place.
+        :return: Path of the scratch directory
+        """
+        if self.scratch_directory is None:
+            self.scratch_directory = tempfile.mkdtemp(prefix="sfr_%s_" % self.item_id,
+                                                      dir=self.work_directory or os.getcwd())
+        return self.scratch_directory
 
     def get_zip_file_and_extract(self):
         """
-        Get item JSON, download zipfile, and extract it in current working directory
+        Get item JSON, download zipfile, and extract it in the pipeline's scratch directory.
+        With read_from_zip the zip is left packed and opened through /vsizip/, and with
+        stream_from_url nothing is written to disk at all.
         :return:
         """
-        sb = pysb.SbSession()
-        item = sb.get_item(self.item_id)
-        zip_file = self.get_zip_file(item)
+        zip_file = None
+        if self.cache_directory and self.use_cached_item and not self.stream_from_url:
+            zip_file = self.find_cached_zip_file()
+
+        if zip_file is None:
+            sb = pysb.SbSession()
+            item = sb.get_item(self.item_id)
+            zip_file = self.get_zip_file(item)
         download_uri = zip_file["downloadUri"]
         file_size = zip_file["size"]
 
         if download_uri is not None:
-            self.zip_file = self.item_id + zip_file["name"]
-            self.download_file(download_uri, file_size)
-            self.extract_zip_file()
+            if self.stream_from_url:
+                # ScienceBase download URIs don't end in .zip, so the braces tell GDAL where the archive path ends
+                self.directory = "/vsizip/{/vsicurl/" + download_uri + "}"
+                return
+            self.zip_name = self.item_id + zip_file["name"]
+            if self.cache_directory:
+                self.zip_file = self.get_cached_zip_file(zip_file)
+                self.zip_cached = True
+            else:
+                self.zip_file = os.path.join(self.get_scratch_directory(), self.zip_name)
+                with self.time_stage("download", url=download_uri):
+                    self.download_file(download_uri, file_size)
+            if self.read_from_zip:
+                self.directory = "/vsizip/" + self.zip_file
+            else:
+                with self.time_stage("extract", zip_file=self.zip_file):
+                    self.extract_zip_file()
         else:
             raise Exception("No URI was found for zipfile download")
 
+    def get_cache_key(self, zip_file):
+        """
+        Build the cache key for a zip file from the item ID, file name, size and checksum
+        :param zip_file: JSON block of zipfile in SB item
+        :return: Hex digest identifying this version of the file
+        """
+        checksum = zip_file.get("checksum") or {}
+        fingerprint = "%s|%s|%s|%s" % (self.item_id, zip_file["name"], zip_file["size"], checksum.get("value", ""))
+        return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+    def get_cached_zip_file(self, zip_file):
+        """
+        Return the path to the cached copy of the zip file, downloading it into the cache on a miss
+        :param zip_file: JSON block of zipfile in SB item
+        :return: Path of the zip file in the cache directory
+        """
+        os.makedirs(self.cache_directory, exist_ok=True)
+        cache_key = self.get_cache_key(zip_file)
+        cache_path = os.path.join(self.cache_directory, cache_key + ".zip")
+
+        with cache_lock:
+            download_lock = cache_download_locks.setdefault(cache_key, threading.Lock())
+
+        with download_lock:
+            # Pin before checking the cache so eviction can't remove the file between the check and the load
+            self.pin_cached_zip_file(cache_path)
+            if os.path.exists(cache_path) and os.path.getsize(cache_path) == zip_file["size"]:
+                print("Using cached zip file", cache_path, flush=True)
+                os.utime(cache_path)
+                return cache_path
+
+            part_file, self.zip_file = tempfile.mkstemp(prefix=cache_key + ".", suffix=".part",
+                                                        dir=self.cache_directory)
+            os.close(part_file)
+            try:
+                with self.time_stage("download", url=zip_file["downloadUri"]):
+                    self.download_file(zip_file["downloadUri"], zip_file["size"])
+                os.replace(self.zip_file, cache_path)
+            except:
+                if os.path.exists(self.zip_file):
+                    os.remove(self.zip_file)
+                self.release_cached_zip_file()
+                raise
+
+            with open(os.path.join(self.cache_directory, cache_key + ".json"), 'w') as f:
+                json.dump({"item_id": self.item_id, "zipfile_title": self.zipfile_title, "file": zip_file}, f)
+
+        self.evict_cache(keep=cache_path)
+        return cache_path
+
+    def pin_cached_zip_file(self, cache_path):
+        """
+        Mark a cached zip file as in use by this pipeline so evict_cache leaves it alone
+        :param cache_path: Path of the zip file in the cache directory
+        :return: None
+        """
+        self.release_cached_zip_file()
+        with cache_lock:
+            cache_pins[cache_path] = cache_pins.get(cache_path, 0) + 1
+        self.pinned_zip_file = cache_path
+
+    def release_cached_zip_file(self):
+        """
+        Drop this pipeline's pin on its cached zip file, if it has one
+        :return: None
+        """
+        if self.pinned_zip_file is None:
+            return
+        with cache_lock:
+            cache_pins[self.pinned_zip_file] = cache_pins[self.pinned_zip_file] - 1
+            if cache_pins[self.pinned_zip_file] == 0:
+                del cache_pins[self.pinned_zip_file]
+        self.pinned_zip_file = None
+
+    def find_cached_zip_file(self):
+        """
+        Find the most recently cached zip file for this item and zipfile_title
+        :return: JSON block of the cached zipfile, or None
+        """
+        if not os.path.isdir(self.cache_directory):
+            return None
+
+        newest = None
+        for file in os.listdir(self.cache_directory):
+            if not file.endswith(".json"):
+                continue
+            zip_path = os.path.join(self.cache_directory, file[0:-5] + ".zip")
+            if not os.path.exists(zip_path):
+                continue
+            with open(os.path.join(self.cache_directory, file)) as f:
+                entry = json.load(f)
+            if entry["item_id"] == self.item_id and entry["zipfile_title"] == self.zipfile_title:
+                mtime = os.path.getmtime(zip_path)
+                if newest is None or mtime > newest[0]:
+                    newest = (mtime, entry["file"])
+
+        return newest[1] if newest is not None else None
+
+    def evict_cache(self, keep=None):
+        """
+        Remove least recently used zip files until the cache fits in cache_max_bytes. Zip files pinned by a
+        pipeline in this process are never evicted.
+        :param keep: Path of a zip file that must not be evicted
+        :return: None
+        """
+        with cache_lock:
+            entries = []
+            total = 0
+            for file in os.listdir(self.cache_directory):
+                if file.endswith(".zip"):
+                    path = os.path.join(self.cache_directory, file)
+                    try:
+                        size = os.path.getsize(path)
+                        mtime = os.path.getmtime(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((mtime, path, size))
+                    total = total + size
+
+            for mtime, path, size in sorted(entries):
+                if total <= self.cache_max_bytes:
+                    break
+                if path == keep or path in cache_pins:
+                    continue
+                print("Evicting cached zip file", path, flush=True)
+                os.remove(path)
+                sidecar = path[0:-4] + ".json"
+                if os.path.exists(sidecar):
+                    os.remove(sidecar)
+                total = total - size
+
+    def list_source_files(self):
+        """
+        List the files available in the source, relative to self.directory. Zip members are
+        listed from the central directory, so nothing has to be extracted to find them.
+        :return: List of file names
+        """
+        if self.stream_from_url:
+            file_names = gdal.ReadDirRecursive(self.directory) or []
+        elif self.read_from_zip:
+            with zipfile.ZipFile(self.zip_file, 'r') as zip_file:
+                file_names = zip_file.namelist()
+        else:
+            return os.listdir(self.directory)
+        return [f for f in file_names if not f.endswith("/") and not f.startswith("__MACOSX/")]
+
     def set_spatial_file_shape_file(self):
         """
         Set the spatial file with the name of the first shape file in the extracted directory
         :return: None
         """
-        for file in os.listdir(self.directory):
-            if file.endswith(".shp"):
-                self.spatial_file_list.append(os.path.join(self.directory, file))
+        self.set_spatial_file_type(".shp")
 
     def set_spatial_file_geojson(self):
         """
         Set the spatial file with the name of the first geojson file in the extracted directory
         :return: None
         """
-        for file in os.listdir(self.directory):
-            if file.endswith(".geojson"):
-                self.spatial_file_list.append(os.path.join(self.directory, file))
+        self.set_spatial_file_type(".geojson")
 
     def set_spatial_file_type(self, spatial_file_type):
         """
@@ -173,7 +496,7 @@ class SfrPipeline:
         :param spatial_file_type: File type -- ".geojson" or ".shp" for example
         :return: None
         """
-        for file in os.listdir(self.directory):
+        for file in self.list_source_files():
             if file.endswith(spatial_file_type):
                 self.spatial_file_list.append(os.path.join(self.directory, file))
 
@@ -197,6 +520,9 @@ class SfrPipeline:
                 db_layer.CreateField(layer_definition.GetFieldDefn(i))
             else:
                 print("Got source date")
+        # Every load stores feature hashes, so a later delta load always has something to compare against
+        if db_layer.GetLayerDefn().GetFieldIndex(self.feature_hash_column) < 0:
+            db_layer.CreateField(ogr.FieldDefn(self.feature_hash_column, ogr.OFTString))
         return db_layer
 
     @staticmethod
@@ -276,25 +602,149 @@ class SfrPipeline:
                 multipolygon.AddGeometry(poly)
         return multipolygon
 
-    def copy_features(self, src_layer, dest_layer, start_count):
+    def get_coordinate_transformation(self, src_layer):
+        """
+        Get the transformation from the source layer's CRS to srid. Transformations are cached by source CRS
+        so files sharing a projection reuse the same one.
+        :param src_layer: Source of spatial data
+        :return: osr.CoordinateTransformation, or None if no reprojection is needed
+        """
+        if not self.reproject:
+            return None
+
+        src_srs = src_layer.GetSpatialRef()
+        if src_srs is None:
+            return None
+
+        src_wkt = src_srs.ExportToWkt()
+        if src_wkt not in self.transformations:
+            src_srs = src_srs.Clone()
+            dest_srs = osr.SpatialReference()
+            dest_srs.ImportFromEPSG(self.srid)
+            if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+                # GDAL 3 otherwise follows the authority axis order (lat/lng for EPSG:4326)
+                src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                dest_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            if src_srs.IsSame(dest_srs):
+                self.transformations[src_wkt] = None
+            else:
+                self.transformations[src_wkt] = osr.CoordinateTransformation(src_srs, dest_srs)
+        return self.transformations[src_wkt]
+
+    def read_features(self, src_layer, transform=None):
+        """
+        Yield the features of the source layer, reprojected if a transformation is given. Features are read
+        sequentially so drivers like GeoJSON are never asked for random access, and the attribute and spatial
+        filters are pushed down to the driver.
+        :param src_layer: Source of spatial data
+        :param transform: osr.CoordinateTransformation to apply, or None
+        :return: Generator of features
+        """
+        if self.attribute_filter is not None:
+            src_layer.SetAttributeFilter(self.attribute_filter)
+        if self.spatial_filter is not None:
+            if isinstance(self.spatial_filter, str):
+                src_layer.SetSpatialFilter(ogr.CreateGeometryFromWkt(self.spatial_filter))
+            else:
+                src_layer.SetSpatialFilterRect(*self.spatial_filter)
+        src_layer.ResetReading()
+
+        while True:
+            feature = src_layer.GetNextFeature()
+            if feature is None:
+                break
+            if transform is not None:
+                # Transform runs over the whole geometry in C, which beats pulling the vertices into Python
+                geom = feature.GetGeometryRef()
+                if geom is not None:
+                    geom.Transform(transform)
+            yield feature
+
+    @staticmethod
+    def get_feature_hash(feature, skip_index=-1):
+        """
+        Hash a feature's attributes and WKB geometry
+        :param feature: Feature to hash
+        :param skip_index: Index of a field to leave out (the hash column itself)
+        :return: Hex digest
+        """
+        digest = hashlib.sha1()
+        for i in range(feature.GetFieldCount()):
+            if i != skip_index:
+                digest.update(repr(feature.GetField(i)).encode())
+                digest.update(b"\x1f")
+        geom = feature.GetGeometryRef()
+        if geom is not None:
+            digest.update(geom.ExportToWkb())
+        return digest.hexdigest()
+
+    def read_existing_hashes(self, db_layer):
+        """
+        Read the feature hashes already stored in the table so a delta load can skip unchanged features
+        :param db_layer: Existing table
+        :return: None
+        """
+        layer_defn = db_layer.GetLayerDefn()
+        if layer_defn.GetFieldIndex(self.feature_hash_column) < 0:
+            db_layer.CreateField(ogr.FieldDefn(self.feature_hash_column, ogr.OFTString))
+            layer_defn = db_layer.GetLayerDefn()
+
+        self.delta_hashes = {}
+        self.delta_changes = {"inserted": [], "deleted": [], "unchanged": 0}
+        self.next_fid = 1
+
+        ignored_fields = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())
+                          if layer_defn.GetFieldDefn(i).GetName() != self.feature_hash_column]
+        db_layer.SetIgnoredFields(ignored_fields + ["OGR_GEOMETRY"])
+        try:
+            db_layer.ResetReading()
+            feature = db_layer.GetNextFeature()
+            while feature is not None:
+                fid = feature.GetFID()
+                self.delta_hashes.setdefault(feature.GetField(self.feature_hash_column), []).append(fid)
+                if fid >= self.next_fid:
+                    self.next_fid = fid + 1
+                feature = db_layer.GetNextFeature()
+        finally:
+            db_layer.SetIgnoredFields([])
+
+    def delete_stale_features(self, db_layer):
+        """
+        Delete the features whose hashes were not seen in the new data
+        :param db_layer: Table being delta loaded
+        :return: None
+        """
+        for fids in self.delta_hashes.values():
+            for fid in fids:
+                db_layer.DeleteFeature(fid)
+                self.delta_changes["deleted"].append(fid)
+        self.delta_hashes = {}
+
+    def copy_features(self, src_layer, dest_layer, start_count, transform=None):
         """
         Iterate through each feature, converting polygons to multipolygons if needed then add them to the postgis table
         :param src_layer: Source of spatial data
         :param dest_layer: Table to add geom to
+        :param transform: osr.CoordinateTransformation to reproject the geometries with, or None
         :return: None
         """
-        src_len = len(src_layer)
         total = start_count
-        for x in range(src_len):
+        fix_seconds = 0.0
+        fix_calls = 0
+        geometry_bytes = 0
+        max_geometry_bytes = self.stats["counters"].get("max_geometry_bytes", 0)
+        hash_index = dest_layer.GetLayerDefn().GetFieldIndex(self.feature_hash_column)
+        for feature in self.read_features(src_layer, transform):
             total = total + 1
             if total % 100 == 0:
                 print(total, flush=True)
-            feature = src_layer[x]
             out_layer_defn = dest_layer.GetLayerDefn()
             geom = feature.GetGeometryRef()
             out_feature = ogr.Feature(out_layer_defn)
 
             for i in range(out_layer_defn.GetFieldCount()):
+                if i == hash_index:
+                    continue
                 field_defn = out_layer_defn.GetFieldDefn(i)
                 field_name = field_defn.GetName()
                 field_type = field_defn.GetType()
@@ -316,12 +766,41 @@ class SfrPipeline:
                     if geom.GetGeometryType() == ogr.wkbPolygon:
                         geom = ogr.ForceToMultiPolygon(geom)
                     if self.clean_up_geom:
+                        fix_start = time.perf_counter()
                         geom = self.fix_geometry(geom, total)
+                        fix_seconds = fix_seconds + time.perf_counter() - fix_start
+                        fix_calls = fix_calls + 1
                     if self.fit_to_bounding_box:
                         geom = self.fit_geom_to_bounding_box(geom)
+            if geom:
+                wkb_size = geom.WkbSize()
+                geometry_bytes = geometry_bytes + wkb_size
+                if wkb_size > max_geometry_bytes:
+                    max_geometry_bytes = wkb_size
             out_feature.SetGeometryDirectly(geom)
-            out_feature.SetFID(total)
+            if self.delta_hashes is not None:
+                feature_hash = self.get_feature_hash(out_feature, hash_index)
+                existing_fids = self.delta_hashes.get(feature_hash)
+                if existing_fids:
+                    # Unchanged feature, keep the row that is already there
+                    existing_fids.pop()
+                    if not existing_fids:
+                        del self.delta_hashes[feature_hash]
+                    self.delta_changes["unchanged"] = self.delta_changes["unchanged"] + 1
+                    continue
+                out_feature.SetField(hash_index, feature_hash)
+                out_feature.SetFID(self.next_fid)
+                self.delta_changes["inserted"].append(self.next_fid)
+                self.next_fid = self.next_fid + 1
+            else:
+                if hash_index >= 0:
+                    out_feature.SetField(hash_index, self.get_feature_hash(out_feature, hash_index))
+                out_feature.SetFID(total)
             dest_layer.CreateFeature(out_feature)
+        if fix_calls:
+            self.record_stage("fix_geometry", fix_seconds, calls=fix_calls)
+        self.increment_counter("geometry_bytes", geometry_bytes)
+        self.stats["counters"]["max_geometry_bytes"] = max_geometry_bytes
         return total
 
     @staticmethod
@@ -331,7 +810,10 @@ class SfrPipeline:
         :param src_layer: Source spatial file
         :return: Geometry type
         """
-        first_obj = src_layer.GetFeature(0).GetGeometryRef()
+        src_layer.ResetReading()
+        first_feature = src_layer.GetNextFeature()
+        src_layer.ResetReading()
+        first_obj = first_feature.GetGeometryRef() if first_feature is not None else None
         if first_obj:
             return first_obj.GetGeometryType()
         else:
@@ -342,11 +824,6 @@ class SfrPipeline:
         Import spatial file into postgis
         :return: None
         """
-        if self.custom_encoding is not None:
-            os.environ["PGCLIENTENCODING"] = self.custom_encoding
-        else:
-            os.environ["PGCLIENTENCODING"] = ""
-
         ogr_sf = None
         ogr_db = None
 
@@ -360,10 +837,20 @@ class SfrPipeline:
             )
 
             # Create ogr object for postgis
-            ogr_db = ogr.Open("PG:" + connection_string)
+            if self.ogr_destination is not None:
+                ogr_db = ogr.Open(self.ogr_destination, 1)
+            else:
+                with pg_client_encoding_lock:
+                    if self.custom_encoding is not None:
+                        os.environ["PGCLIENTENCODING"] = self.custom_encoding
+                    else:
+                        os.environ["PGCLIENTENCODING"] = ""
+                    ogr_db = ogr.Open("PG:" + connection_string)
             first_layer = True
             db_layer = None
             block = 0
+            self.delta_hashes = None
+            self.delta_changes = None
 
             # This is for testing
             # last = len(self.spatial_file_list)
@@ -375,6 +862,7 @@ class SfrPipeline:
                 shape_file_layer = ogr_sf.GetLayer(0)
 
                 print("CRS:", shape_file_layer.GetSpatialRef())
+                transform = self.get_coordinate_transformation(shape_file_layer)
 
                 if first_layer:
                     first_layer = False
@@ -382,15 +870,45 @@ class SfrPipeline:
                     wkb_type = self.get_wkb_type(shape_file_layer)
                     if wkb_type == ogr.wkbPolygon:
                         wkb_type = ogr.wkbMultiPolygon
-                    db_layer = self.create_layer_from_definition(
-                        ogr_db,
-                        layer_definition,
-                        wkb_type
-                    )
-
-                block = self.copy_features(shape_file_layer, db_layer, block)
-                ogr_db.SyncToDisk()
+                    if self.load_mode == "delta":
+                        db_layer = ogr_db.GetLayerByName(self.schema + '.' + self.table)
+                    if db_layer is None:
+                        with self.time_stage("create_layer", table=self.schema + '.' + self.table):
+                            db_layer = self.create_layer_from_definition(
+                                ogr_db,
+                                layer_definition,
+                                wkb_type
+                            )
+                    if self.load_mode == "delta":
+                        with self.time_stage("read_hashes"):
+                            self.read_existing_hashes(db_layer)
+
+                with self.time_stage("copy_features", spatial_file=spatial_file) as info:
+                    if self.profile_copy_features:
+                        if self.profiler is None:
+                            self.profiler = cProfile.Profile()
+                        self.profiler.enable()
+                    try:
+                        copied = self.copy_features(shape_file_layer, db_layer, block, transform)
+                    finally:
+                        if self.profiler is not None:
+                            self.profiler.disable()
+                    info["features"] = copied - block
+                block = copied
+                self.increment_counter("features", info["features"])
+                self.increment_counter("files")
+                with self.time_stage("sync"):
+                    ogr_db.SyncToDisk()
                 ogr_sf.Destroy()
+
+            if self.delta_hashes is not None:
+                with self.time_stage("delete_stale"):
+                    self.delete_stale_features(db_layer)
+                with self.time_stage("sync"):
+                    ogr_db.SyncToDisk()
+                self.increment_counter("delta_inserted", len(self.delta_changes["inserted"]))
+                self.increment_counter("delta_deleted", len(self.delta_changes["deleted"]))
+                self.increment_counter("delta_unchanged", self.delta_changes["unchanged"])
         except:
             # Close connections before raising exception
             if ogr_sf is not None:
@@ -406,11 +924,21 @@ class SfrPipeline:
 
     def clean_up_files(self):
         """
-        Remove zip file and directory from extracted zip
+        Remove zip file and directory from extracted zip, along with the pipeline's scratch directory. Zip files
+        kept in the cache directory are left in place and unpinned.
         :return: None
         """
-        os.remove(self.zip_file)
-        shutil.rmtree(self.directory)
+        try:
+            if self.zip_file is not None and not self.zip_cached and os.path.exists(self.zip_file):
+                os.remove(self.zip_file)
+            if self.extracted:
+                shutil.rmtree(self.directory)
+                self.extracted = False
+        finally:
+            if self.scratch_directory is not None:
+                shutil.rmtree(self.scratch_directory, ignore_errors=True)
+                self.scratch_directory = None
+            self.release_cached_zip_file()
 
     def check_and_set_spatial_file_type(self):
         """
@@ -424,6 +952,26 @@ class SfrPipeline:
             if not self.spatial_file_list:
                 self.set_spatial_file_type(".shp")
 
+    def choose_batch_size(self):
+        """
+        Pick the pg2elastic batch size from the average WKB size of the geometries loaded, so point layers
+        are indexed in large batches and complex polygon layers in small ones. The batch is also capped so that
+        a batch of the largest geometry stays within index_worst_case_factor times the target, which keeps a few
+        huge polygons in a mostly small layer from timing out the index request.
+        :return: Number of geometries to index at a time
+        """
+        features = self.stats["counters"].get("features", 0)
+        geometry_bytes = self.stats["counters"].get("geometry_bytes", 0)
+        if not features or not geometry_bytes:
+            return 5
+
+        batch_size = int(self.index_target_batch_bytes // (geometry_bytes / features))
+        max_geometry_bytes = self.stats["counters"].get("max_geometry_bytes", 0)
+        if max_geometry_bytes:
+            batch_size = min(batch_size,
+                             int(self.index_worst_case_factor * self.index_target_batch_bytes // max_geometry_bytes))
+        return max(1, min(self.index_max_batch_size, batch_size))
+
     def add_index_job_to_queue(self,
                                schema,
                                table,
@@ -453,11 +1001,12 @@ class SfrPipeline:
 
         return requests.request(method='get', url=pg2elastic).json()
 
-    def spatial_file_to_postgis(self):
+    def prepare_spatial_files(self):
         """
-        Run the full process of adding the SB item's spatial file to Postgis
+        Download the SB item's zip file and find the spatial files in it
         :return: None
         """
+        self.reset_stats()
         self.get_zip_file_and_extract()
         self.check_and_set_spatial_file_type()
 
@@ -465,13 +1014,167 @@ class SfrPipeline:
             self.clean_up_files()
             raise Exception("No spatial file found in extracted zip")
 
+    def spatial_file_to_postgis(self):
+        """
+        Run the full process of adding the SB item's spatial file to Postgis
+        :return: None
+        """
+        self.prepare_spatial_files()
         self.create_table_from_spatial_file()
         self.clean_up_files()
 
+    def index_table(self):
+        """
+        Queue the pg2elastic index job for the loaded table. After a delta load that changed nothing the
+        index job is skipped.
+        :return: Summary of stage timings and counters (see get_summary) with the index batch size and response
+        """
+        if self.delta_changes is not None and not self.delta_changes["inserted"] and not self.delta_changes["deleted"]:
+            summary = self.get_summary()
+            summary["index_batch_size"] = None
+            summary["index_response"] = None
+            return summary
+
+        batch_size = self.batch_size or self.choose_batch_size()
+        with self.time_stage("index_queue", batch_size=batch_size):
+            response = self.add_index_job_to_queue(self.schema, self.table, batch_size, self.make_valid)
+        summary = self.get_summary()
+        summary["index_batch_size"] = batch_size
+        summary["index_response"] = response
+        return summary
+
     def run_full_pipeline(self):
         """
         Run through full shape file -> postgis -> elasticsearch pipeline
-        :return:
+        :return: Summary of stage timings and counters (see get_summary)
         """
         self.spatial_file_to_postgis()
-        self.add_index_job_to_queue()
+        return self.index_table()
+
+
+class SfrBatchRunner:
+
+    def __init__(self, manifest, download_workers=4, max_db_connections=2, max_pending=None,
+                 index=True, report_file=None):
+        """
+        Run the SFR pipeline for many ScienceBase items. Downloads run on one thread pool and loads on another,
+        so the next items download while the current ones are loading.
+        :param manifest: List of SfrPipeline parameter dicts, or the path to a JSON or YAML file holding one
+        :param download_workers: Number of concurrent downloads
+        :param max_db_connections: Number of concurrent loads, and so of open Postgis connections
+        :param max_pending: Most items downloaded or downloading but not yet loaded (limits scratch disk use)
+        :param index: Queue the pg2elastic index job after each load
+        :param report_file: Write the per-item results to this JSON file when the run finishes
+        """
+        self.description = "Run the SFR pipeline for a manifest of ScienceBase items"
+        if isinstance(manifest, str):
+            manifest = self.load_manifest(manifest)
+        self.manifest = manifest
+        self.download_workers = download_workers
+        self.max_db_connections = max_db_connections
+        self.max_pending = max_pending or download_workers + max_db_connections
+        self.index = index
+        self.report_file = report_file
+        self.results = []
+
+    @staticmethod
+    def load_manifest(manifest_file):
+        """
+        Read a manifest of SfrPipeline parameter dicts
+        :param manifest_file: Path to a .json, .yaml or .yml file containing a list of parameter dicts
+        :return: List of parameter dicts
+        """
+        with open(manifest_file) as f:
+            if manifest_file.endswith((".yaml", ".yml")):
+                import yaml
+                return yaml.safe_load(f)
+            return json.load(f)
+
+    def download_item(self, index, params, load_pool, pending):
+        """
+        Download and prepare one item, then hand it to the load pool
+        :return: None
+        """
+        result = self.results[index]
+        start = time.perf_counter()
+        pipeline = None
+        try:
+            pipeline = SfrPipeline(params)
+            pipeline.prepare_spatial_files()
+        except Exception as e:
+            result["status"] = "failed"
+            result["failed_stage"] = "download"
+            result["error"] = str(e)
+            try:
+                if pipeline is not None:
+                    self.clean_up_item(pipeline, result)
+            finally:
+                pending.release()
+            return
+        finally:
+            result["download_seconds"] = time.perf_counter() - start
+
+        load_pool.submit(self.load_item, index, pipeline, pending)
+
+    def load_item(self, index, pipeline, pending):
+        """
+        Load one prepared item into Postgis and queue its index job
+        :return: None
+        """
+        result = self.results[index]
+        start = time.perf_counter()
+        stage = "load"
+        try:
+            pipeline.create_table_from_spatial_file()
+            self.clean_up_item(pipeline, result)
+            if self.index:
+                stage = "index"
+                result["summary"] = pipeline.index_table()
+            else:
+                result["summary"] = pipeline.get_summary()
+            result["status"] = "ok"
+        except Exception as e:
+            result["status"] = "failed"
+            result["failed_stage"] = stage
+            result["error"] = str(e)
+        finally:
+            try:
+                self.clean_up_item(pipeline, result)
+                result["load_seconds"] = time.perf_counter() - start
+            finally:
+                pending.release()
+
+    @staticmethod
+    def clean_up_item(pipeline, result):
+        """
+        Remove an item's files, recording a failure in its result rather than raising, since a failed clean up
+        leaves the load itself intact
+        :param pipeline: SfrPipeline for the item
+        :param result: Result dict for the item
+        :return: None
+        """
+        try:
+            pipeline.clean_up_files()
+        except Exception as e:
+            result["cleanup_error"] = str(e)
+
+    def run(self):
+        """
+        Run every item in the manifest
+        :return: List of per-item result dicts, in manifest order
+        """
+        self.results = [{"item_id": params.get("item_id"), "table": params.get("table"), "status": "pending"}
+                        for params in self.manifest]
+        pending = threading.BoundedSemaphore(self.max_pending)
+
+        with ThreadPoolExecutor(max_workers=self.max_db_connections) as load_pool:
+            with ThreadPoolExecutor(max_workers=self.download_workers) as download_pool:
+                for index, params in enumerate(self.manifest):
+                    pending.acquire()
+                    download_pool.submit(self.download_item, index, params, load_pool, pending)
+
+        if self.report_file is not None:
+            with open(self.report_file, 'w') as f:
+                json.dump(self.results, f, indent=2, default=str)
+
+        return self.results
@@ -0,0 +1,245 @@
+import threading
+import time
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Taxonomic Information Registry (TIR) enrichment engine.
+
+This class takes a stream of scientific names, cleans them with
+Bis.clean_scientific_name, and looks each one up in the TIR sources
+concurrently. Sources are arranged as a dependency graph: a source runs as soon
+as the sources it depends on have finished for that name (TESS waits for ITIS so
+it can query by TSN), and independent sources run side by side. Many names are
+in flight at once, and finished records are written to MongoDB in batches.
+
+GAP species (Gap.gap_to_tir) work from ScienceBase items rather than names, so
+they are not part of the default sources; add them with a custom source if the
+records carry the item.
+"""
+
+
+def itis_source(record):
+    from pybis.itis import Itis as itis
+    return itis.check_itis_solr(record["Cleaned Name"])
+
+
+def worms_source(record):
+    from pybis.worms import Worms as worms
+    return worms.lookup_worms(record["Cleaned Name"])
+
+
+def natureserve_source(record):
+    from pybis.natureserve import Natureserve as natureserve
+    return natureserve.query_natureserve(record["Cleaned Name"])
+
+
+def tess_source(record):
+    from pybis.tess import Tess as tess
+
+    # Query TESS by the ITIS TSN when ITIS found one, otherwise fall back to the scientific name
+    itisData = record.get("ITIS", {}).get("itisData", [])
+    if len(itisData) > 0 and "tsn" in itisData[0]:
+        return tess.tess_query(tess.get_tess_search_url("TSN", itisData[0]["tsn"]))
+    return tess.tess_query(tess.get_tess_search_url("SCINAME", record["Cleaned Name"]))
+
+
+class TirEngine:
+
+    default_sources = {
+        "ITIS": ([], itis_source),
+        "WoRMS": ([], worms_source),
+        "NatureServe": ([], natureserve_source),
+        "TESS": (["ITIS"], tess_source)
+    }
+
+    def __init__(self, mongo_container=None, sources=None, max_workers=8, max_names_in_flight=32, batch_size=100):
+        """
+        :param mongo_container: MongoDB collection to write the finished records to; records are returned if None
+        :param sources: Dict of source name -> (list of source names it depends on, function taking the record so far)
+        :param max_workers: Number of source lookups running at once
+        :param max_names_in_flight: Number of names being enriched at once
+        :param batch_size: Number of finished records per MongoDB bulk write
+        """
+        self.description = "Concurrent enrichment of scientific names from the TIR sources"
+        self.mongo_container = mongo_container
+        self.sources = sources or self.default_sources
+        self.max_workers = max_workers
+        self.max_names_in_flight = max_names_in_flight
+        self.batch_size = batch_size
+
+        for source, (dependencies, function) in self.sources.items():
+            for dependency in dependencies:
+                if dependency not in self.sources:
+                    raise Exception("Source %s depends on unknown source %s" % (source, dependency))
+
+        # A cycle would leave names waiting forever on sources that can never start
+        resolved = set()
+        while len(resolved) < len(self.sources):
+            ready = [s for s, (dependencies, function) in self.sources.items()
+                     if s not in resolved and all(d in resolved for d in dependencies)]
+            if len(ready) == 0:
+                raise Exception("Source dependencies contain a cycle: %s" % sorted(set(self.sources) - resolved))
+            resolved.update(ready)
+
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Clear the throughput and per-source latency stats
+        :return: None
+        """
+        self.stats = {
+            "names": 0,
+            "records_written": 0,
+            "seconds": 0.0,
+            "sources": dict((source, {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+                            for source in self.sources)
+        }
+
+    def record_latency(self, source, seconds, failed):
+        with self.stats_lock:
+            source_stats = self.stats["sources"][source]
+            source_stats["calls"] = source_stats["calls"] + 1
+            source_stats["total_seconds"] = source_stats["total_seconds"] + seconds
+            source_stats["max_seconds"] = max(source_stats["max_seconds"], seconds)
+            if failed:
+                source_stats["errors"] = source_stats["errors"] + 1
+
+    def get_summary(self):
+        """
+        Summarize throughput and per-source latency
+        :return: Dict of stats
+        """
+        with self.stats_lock:
+            summary = {
+                "names": self.stats["names"],
+                "records_written": self.stats["records_written"],
+                "seconds": self.stats["seconds"],
+                "sources": {}
+            }
+            for source, source_stats in self.stats["sources"].items():
+                summary["sources"][source] = dict(source_stats)
+                if source_stats["calls"] > 0:
+                    summary["sources"][source]["mean_seconds"] = source_stats["total_seconds"] / source_stats["calls"]
+        if summary["seconds"] > 0:
+            summary["names_per_second"] = summary["names"] / summary["seconds"]
+        return summary
+
+    def ready_sources(self, job):
+        """
+        Sources for this name that have not started and whose dependencies have all finished
+        :param job: State of the name being enriched
+        :return: List of source names
+        """
+        return [source for source, (dependencies, function) in self.sources.items()
+                if source not in job["started"] and all(d in job["finished"] for d in dependencies)]
+
+    def run_source(self, executor, job, source, completed):
+        """
+        Run one source lookup for a name, then start whatever it unblocked
+        :return: None
+        """
+        dependencies, function = self.sources[source]
+        start = time.perf_counter()
+        failed = False
+        try:
+            result = function(job["record"])
+        except Exception as e:
+            result = {"Error": str(e)}
+            failed = True
+        self.record_latency(source, time.perf_counter() - start, failed)
+
+        with job["lock"]:
+            job["record"][source] = result
+            job["finished"].add(source)
+            ready = self.ready_sources(job)
+            job["started"].update(ready)
+            done = len(job["finished"]) == len(self.sources)
+
+        for next_source in ready:
+            executor.submit(self.run_source, executor, job, next_source, completed)
+        if done:
+            completed.put(job["record"])
+
+    def write_batch(self, batch, results):
+        """
+        Write finished records to MongoDB, or keep them to return if there is no container
+        :return: None
+        """
+        if len(batch) == 0:
+            return
+        if self.mongo_container is not None:
+            from pymongo import ReplaceOne
+            self.mongo_container.bulk_write([ReplaceOne({"_id": record["_id"]}, record, upsert=True) for record in batch],
+                                            ordered=False)
+        else:
+            results.extend(batch)
+        with self.stats_lock:
+            self.stats["records_written"] = self.stats["records_written"] + len(batch)
+
+    def run(self, scientificnames):
+        """
+        Enrich a stream of scientific names
+        :param scientificnames: Iterable of scientific names; each is cleaned with Bis.clean_scientific_name
+        :return: List of records if there is no MongoDB container, otherwise an empty list (see get_summary for stats)
+        """
+        from pybis.bis import Bis as bis
+
+        self.reset_stats()
+        start = time.perf_counter()
+        completed = Queue()
+        in_flight = threading.BoundedSemaphore(self.max_names_in_flight)
+        results = []
+        batch = []
+        seen_names = set()
+        submitted = 0
+        received = 0
+
+        def collect(record):
+            nonlocal received, batch
+            batch.append(record)
+            received = received + 1
+            in_flight.release()
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch, results)
+                batch = []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for scientificname in scientificnames:
+                cleaned_name = bis.clean_scientific_name(scientificname)
+                if not cleaned_name or cleaned_name in seen_names:
+                    continue
+                seen_names.add(cleaned_name)
+
+                # Slots are only freed as finished records are collected, so wait on the queue when none is free
+                while not in_flight.acquire(blocking=False):
+                    collect(completed.get())
+
+                job = {
+                    "record": {"_id": cleaned_name, "Scientific Name": scientificname, "Cleaned Name": cleaned_name},
+                    "started": set(),
+                    "finished": set(),
+                    "lock": threading.Lock()
+                }
+                with job["lock"]:
+                    ready = self.ready_sources(job)
+                    job["started"].update(ready)
+                submitted = submitted + 1
+                for source in ready:
+                    executor.submit(self.run_source, executor, job, source, completed)
+
+                while not completed.empty():
+                    collect(completed.get())
+
+            while received < submitted:
+                collect(completed.get())
+
+        self.write_batch(batch, results)
+
+        with self.stats_lock:
+            self.stats["names"] = submitted
+            self.stats["seconds"] = time.perf_counter() - start
+
+        return results
@@ -1,3 +1,10 @@
+from pybis.bis import LRUCache
+
+# AphiaID -> record, and starting AphiaID -> chain of records reached by following valid_AphiaID
+aphiaRecordCache = LRUCache(20000)
+validChainCache = LRUCache(20000)
+
+
 class Worms:
     def __init__(self):
         self.description = 'Set of functions for working with the World Register of Marine Species'
@@ -22,9 +29,52 @@ class Worms:
         return taxonomy
 
 
+    def get_aphia_record(aphiaID, session=None):
+        import requests
+        from pybis.worms import Worms as worms
+
+        record = aphiaRecordCache.get(aphiaID)
+        if record is None:
+            aphiaIDResults = (session or requests).get(worms.get_worms_search_url("AphiaID",aphiaID))
+            if aphiaIDResults.status_code != 200:
+                return None
+            record = aphiaIDResults.json()
+            aphiaRecordCache.put(aphiaID, record)
+        return record
+
+
+    def resolve_valid_chain(aphiaID, session=None):
+        from pybis.worms import Worms as worms
+
+        chain = validChainCache.get(aphiaID)
+        if chain is not None:
+            return chain
+
+        # Follow valid_AphiaID until a record points at itself or back into the chain, or a lookup fails
+        chain = []
+        seenIDs = set()
+        complete = True
+        nextID = aphiaID
+        while nextID is not None and nextID not in seenIDs:
+            seenIDs.add(nextID)
+            record = worms.get_aphia_record(nextID, session)
+            if record is None:
+                complete = False
+                break
+            chain.append(record)
+            nextID = record.get("valid_AphiaID")
+
+        # A chain cut short by a failed request is not cached so the next lookup can retry it
+        chain = tuple(chain)
+        if complete:
+            validChainCache.put(aphiaID, chain)
+        return chain
+
+
     def lookup_worms(nameString):
         import requests
         from datetime import datetime
+        from pybis.worms import Worms as worms
 
         wormsResult = {}
         wormsResult["Processing Metadata"] = {}
@@ -32,57 +82,140 @@ class Worms:
         wormsResult["Processing Metadata"]["Summary Result"] = "Not Matched"
 
         wormsData = []
-        aphiaIDs = []
+        aphiaIDs = set()
 
-        url_ExactMatch = getWoRMSSearchURL("ExactName",nameString)
+        url_ExactMatch = worms.get_worms_search_url("ExactName",nameString)
         nameResults_exact = requests.get(url_ExactMatch)
 
         if nameResults_exact.status_code == 200:
             wormsDoc = nameResults_exact.json()[0]
-            wormsDoc["taxonomy"] = buildWoRMSTaxonomy(wormsDoc)
+            aphiaRecordCache.put(wormsDoc["AphiaID"], dict(wormsDoc))
+            wormsDoc["taxonomy"] = worms.build_worms_taxonomy(wormsDoc)
             wormsResult["Processing Metadata"]["Search URL"] = url_ExactMatch
             wormsResult["Processing Metadata"]["Summary Result"] = "Exact Match"
             wormsData.append(wormsDoc)
-            if wormsDoc["AphiaID"] not in aphiaIDs:
-                aphiaIDs.append(wormsDoc["AphiaID"])
+            aphiaIDs.add(wormsDoc["AphiaID"])
         else:
-            url_FuzzyMatch = getWoRMSSearchURL("FuzzyName",nameString)
+            url_FuzzyMatch = worms.get_worms_search_url("FuzzyName",nameString)
             wormsResult["Processing Metadata"]["Search URL"] = url_FuzzyMatch
             nameResults_fuzzy = requests.get(url_FuzzyMatch)
             if nameResults_fuzzy.status_code == 200:
                 wormsDoc = nameResults_fuzzy.json()[0]
-                wormsDoc["taxonomy"] = buildWoRMSTaxonomy(wormsDoc)
+                aphiaRecordCache.put(wormsDoc["AphiaID"], dict(wormsDoc))
+                wormsDoc["taxonomy"] = worms.build_worms_taxonomy(wormsDoc)
                 wormsResult["Processing Metadata"]["Summary Result"] = "Fuzzy Match"
                 wormsData.append(wormsDoc)
-                if wormsDoc["AphiaID"] not in aphiaIDs:
-                    aphiaIDs.append(wormsDoc["AphiaID"])
-
-
-        if len(wormsData) > 0 and "valid_AphiaID" in wormsData[0].keys():
-            valid_AphiaID = wormsData[0]["valid_AphiaID"]
-            while valid_AphiaID is not None:
-                if valid_AphiaID not in aphiaIDs:
-                    url_AphiaID = getWoRMSSearchURL("AphiaID",valid_AphiaID)
-                    aphiaIDResults = requests.get(url_AphiaID)
-                    if aphiaIDResults.status_code == 200:
-                        wormsDoc = aphiaIDResults.json()
-                        wormsDoc["taxonomy"] = buildWoRMSTaxonomy(wormsDoc)
-                        wormsResult["Processing Metadata"]["Search URL"] = url_AphiaID
-                        wormsResult["Processing Metadata"]["Summary Result"] = "Followed Valid AphiaID"
-                        wormsData.append(wormsDoc)
-                        if wormsDoc["AphiaID"] not in aphiaIDs:
-                            aphiaIDs.append(wormsDoc["AphiaID"])
-                        if "valid_AphiaID" in wormsDoc.keys():
-                            valid_AphiaID = wormsDoc["valid_AphiaID"]
-                        else:
-                            valid_AphiaID = None
-                    else:
-                        valid_AphiaID = None
-                else:
-                    valid_AphiaID = None
+                aphiaIDs.add(wormsDoc["AphiaID"])
+
+
+        # Most names are already valid (valid_AphiaID == AphiaID), which needs no further requests
+        if len(wormsData) > 0 and wormsData[0].get("valid_AphiaID") is not None \
+                and wormsData[0]["valid_AphiaID"] not in aphiaIDs:
+            for record in worms.resolve_valid_chain(wormsData[0]["valid_AphiaID"]):
+                if record["AphiaID"] in aphiaIDs:
+                    break
+                wormsDoc = dict(record)
+                wormsDoc["taxonomy"] = worms.build_worms_taxonomy(wormsDoc)
+                wormsResult["Processing Metadata"]["Search URL"] = worms.get_worms_search_url("AphiaID",record["AphiaID"])
+                wormsResult["Processing Metadata"]["Summary Result"] = "Followed Valid AphiaID"
+                wormsData.append(wormsDoc)
+                aphiaIDs.add(wormsDoc["AphiaID"])
 
         if len(wormsData) > 0:
             wormsResult["wormsData"] = wormsData
 
         return (wormsResult)
 
+
+
+    def lookup_worms_many(nameStrings, batchSize=50):
+        import requests
+        from datetime import datetime
+        from pybis.worms import Worms as worms
+
+        wormsRestAPI = "http://www.marinespecies.org/rest/"
+        session = requests.Session()
+
+        def records_by_names(names, like):
+            # AphiaRecordsByNames returns one list of records per name, in the order the names were sent
+            nameRecords = {}
+            for start in range(0, len(names), batchSize):
+                batch = names[start:start+batchSize]
+                response = session.get(wormsRestAPI+"AphiaRecordsByNames",
+                                       params={"scientificnames[]":batch,"like":like,"marine_only":"false"})
+                if response.status_code == 200:
+                    for name, records in zip(batch, response.json()):
+                        if records:
+                            nameRecords[name] = records
+            return nameRecords
+
+        def records_by_ids(aphiaIDs):
+            idRecords = {}
+            for aphiaID in aphiaIDs:
+                record = aphiaRecordCache.get(aphiaID)
+                if record is not None:
+                    idRecords[aphiaID] = record
+            aphiaIDs = [aphiaID for aphiaID in aphiaIDs if aphiaID not in idRecords]
+            for start in range(0, len(aphiaIDs), batchSize):
+                batch = aphiaIDs[start:start+batchSize]
+                response = session.get(wormsRestAPI+"AphiaRecordsByAphiaIDs", params={"aphiaids[]":batch})
+                if response.status_code == 200:
+                    for record in response.json():
+                        if record is not None:
+                            idRecords[record["AphiaID"]] = record
+                            aphiaRecordCache.put(record["AphiaID"], record)
+            return idRecords
+
+        names = list(dict.fromkeys(nameStrings))
+        wormsResults = {}
+        wormsData = {}
+        aphiaIDs = {}
+        for nameString in names:
+            wormsResults[nameString] = {"Processing Metadata":{"Date Processed":datetime.utcnow().isoformat(),"Summary Result":"Not Matched"}}
+            wormsData[nameString] = []
+            aphiaIDs[nameString] = []
+
+        def add_doc(nameString, record, summaryResult, searchURL):
+            aphiaRecordCache.put(record["AphiaID"], record)
+            wormsDoc = dict(record)
+            wormsDoc["taxonomy"] = worms.build_worms_taxonomy(wormsDoc)
+            wormsResults[nameString]["Processing Metadata"]["Search URL"] = searchURL
+            wormsResults[nameString]["Processing Metadata"]["Summary Result"] = summaryResult
+            wormsData[nameString].append(wormsDoc)
+            if wormsDoc["AphiaID"] not in aphiaIDs[nameString]:
+                aphiaIDs[nameString].append(wormsDoc["AphiaID"])
+
+        # Same order of attempts as lookup_worms: exact names, then fuzzy for whatever is left
+        exactRecords = records_by_names(names, "false")
+        for nameString, records in exactRecords.items():
+            add_doc(nameString, records[0], "Exact Match", worms.get_worms_search_url("ExactName", nameString))
+
+        unmatchedNames = [n for n in names if n not in exactRecords]
+        for nameString in unmatchedNames:
+            wormsResults[nameString]["Processing Metadata"]["Search URL"] = worms.get_worms_search_url("FuzzyName", nameString)
+        for nameString, records in records_by_names(unmatchedNames, "true").items():
+            add_doc(nameString, records[0], "Fuzzy Match", worms.get_worms_search_url("FuzzyName", nameString))
+
+        # Follow the valid AphiaID chains one level at a time, fetching each level's IDs in bulk
+        pendingIDs = {}
+        for nameString in names:
+            if len(wormsData[nameString]) > 0 and wormsData[nameString][0].get("valid_AphiaID") is not None:
+                pendingIDs[nameString] = wormsData[nameString][0]["valid_AphiaID"]
+
+        while len(pendingIDs) > 0:
+            pendingIDs = dict((n, v) for n, v in pendingIDs.items() if v not in aphiaIDs[n])
+            idRecords = records_by_ids(list(set(pendingIDs.values())))
+            nextIDs = {}
+            for nameString, valid_AphiaID in pendingIDs.items():
+                if valid_AphiaID not in idRecords:
+                    continue
+                add_doc(nameString, idRecords[valid_AphiaID], "Followed Valid AphiaID", worms.get_worms_search_url("AphiaID", valid_AphiaID))
+                if wormsData[nameString][-1].get("valid_AphiaID") is not None:
+                    nextIDs[nameString] = wormsData[nameString][-1]["valid_AphiaID"]
+            pendingIDs = nextIDs
+
+        for nameString in names:
+            if len(wormsData[nameString]) > 0:
+                wormsResults[nameString]["wormsData"] = wormsData[nameString]
+
+        return wormsResults
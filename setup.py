@@ -33,16 +33,19 @@ setup(
 
         'License :: OSI Approved :: CC0',
 
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
     ],
 
     keywords='biogeography',
 
     packages=['pybis'],
+
+# Lazy submodule loading in pybis/__init__.py uses a module level __getattr__ (PEP 562)
+    python_requires='>=3.7',
+
+# pybis.__version__ reads the installed metadata; importlib.metadata is only in the standard library from 3.8
+    install_requires=['importlib_metadata; python_version < "3.8"'],
 )